@@ -1,23 +1,86 @@
+import time
+_INICIO_IMPORTACION = time.time()
+
 import os
+import importlib
+import gc
 import requests
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory
-from bs4 import BeautifulSoup
-import google.generativeai as genai
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, send_from_directory, Response, stream_with_context
 import json
-from functools import lru_cache
-import time
 import re
+import html
+import csv
+import io
+import unicodedata
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 import pytz
+import click
+import sqlite3
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import deque
 
 import threading
+import random
+import hashlib
+import fcntl
+import glob
+import logging
+import logging.handlers
+import queue
+import sys
+import atexit
+import contextvars
+import uuid
+import gzip
+import mmap
+import struct
+import math
+from functools import wraps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Tiempos de arranque de este proceso (ms) para /health: imports diferidos, precarga, calentamiento
+TIEMPOS_ARRANQUE = {}
+
+
+class _ModuloPerezoso:
+    """Importa el módulo en el primer acceso a uno de sus atributos (google.generativeai tarda ~0.7 s)"""
+
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._modulo = None
+
+    def cargar(self):
+        if self._modulo is None:
+            inicio = time.time()
+            self._modulo = importlib.import_module(self._nombre)
+            TIEMPOS_ARRANQUE[f"import_{self._nombre}_ms"] = round((time.time() - inicio) * 1000, 1)
+        return self._modulo
+
+    def __getattr__(self, atributo):
+        valor = getattr(self.cargar(), atributo)
+        setattr(self, atributo, valor)  # los siguientes accesos ya no pasan por aquí
+        return valor
+
+
+genai = _ModuloPerezoso("google.generativeai")
+np = _ModuloPerezoso("numpy")
+bs4 = _ModuloPerezoso("bs4")
 
 app = Flask(__name__, static_folder='static')
 app.secret_key = os.environ.get("SECRET_KEY", "marcasegura-secret-key-2025")
+# /static (logo) con caché larga; Flask agrega ETag/Last-Modified y responde 304
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.environ.get("STATIC_MAX_AGE", 30 * 86400))
 
 # Zona horaria de México
 MEXICO_TZ = pytz.timezone('America/Mexico_City')
@@ -44,17 +107,287 @@ WHATSAPP_NUMERO = os.environ.get("WHATSAPP_NUMERO", "523331562224")
 CAL_COM_URL = os.environ.get("CAL_COM_URL", "https://cal.com/marcasegura/30min")
 APP_BASE_URL = os.environ.get("APP_BASE_URL", "https://consultor-marcas-publica.onrender.com")
 
+# MODO DE EJECUCIÓN: con workers gevent (gunicorn.conf.py) el socket ya viene parcheado al importar la app
+try:
+    from gevent import monkey as _monkey_gevent
+    MODO_GEVENT = _monkey_gevent.is_module_patched("socket")
+except ImportError:
+    MODO_GEVENT = False
+
 # DEBUG MODE
 DEBUG_IMPI = os.environ.get("DEBUG_IMPI", "false").lower() == "true"
 
 # NOTIFICACIONES PUSH (ntfy.sh)
 NTFY_CHANNEL = os.environ.get("NTFY_CHANNEL", "marcasegura-leads-2025")
+NTFY_URL = os.environ.get("NTFY_URL", "https://ntfy.sh").rstrip("/")
+
+# EMAIL (SMTP de Gmail; se puede apuntar a otro servidor, p. ej. el de benchmarks/)
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 587))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "true").lower() == "true"
+# Segundos sin enviar antes de cerrar la conexión persistente; minutos para juntar leads en un resumen (0 = uno por lead)
+SMTP_INACTIVIDAD = float(os.environ.get("SMTP_INACTIVIDAD", 240))
+EMAIL_RESUMEN_MINUTOS = float(os.environ.get("EMAIL_RESUMEN_MINUTOS", 0))
+
+# GEMINI: endpoint alterno de la API REST (vacío = el de Google)
+GEMINI_ENDPOINT = os.environ.get("GEMINI_ENDPOINT", "")
+
+# PERSISTENCIA LOCAL (compartida entre workers de gunicorn)
+DATA_DIR = os.environ.get("DATA_DIR", "/tmp/marcasegura")
+# DATOS DURABLES: leads.db (leads y facturación) y outbox.db (entregas pendientes). En Render debe apuntar a un disco persistente
+# (p. ej. /var/data); sin él se usa DATA_DIR, que se borra en cada deploy o reinicio, y la base
+# local es solo un caché del funnel: el registro sigue siendo Google Sheets.
+DATOS_DURABLES_DIR = os.environ.get("DATOS_DURABLES_DIR", "")
+
+# CACHÉ IMPI (segundos)
+IMPI_CACHE_TTL_DISPONIBLE = int(os.environ.get("IMPI_CACHE_TTL_DISPONIBLE", 6 * 3600))
+IMPI_CACHE_TTL_ANALISIS = int(os.environ.get("IMPI_CACHE_TTL_ANALISIS", 24 * 3600))
+IMPI_CACHE_TTL_ERROR = int(os.environ.get("IMPI_CACHE_TTL_ERROR", 60))
+IMPI_CACHE_STALE = int(os.environ.get("IMPI_CACHE_STALE", 7 * 24 * 3600))
+
+# SESIONES IMPI
+IMPI_ORIGEN = os.environ.get("IMPI_ORIGEN", "https://acervomarcas.impi.gob.mx:8181")
+IMPI_URL_BASE = f"{IMPI_ORIGEN}/marcanet/"
+IMPI_URL_BUSQUEDA = f"{IMPI_ORIGEN}/marcanet/vistas/common/home.pgi"
+IMPI_SESION_TTL = int(os.environ.get("IMPI_SESION_TTL", 600))
+IMPI_POOL_MAX = int(os.environ.get("IMPI_POOL_MAX", 4))
+
+# ANÁLISIS: tiempo máximo total de /analizar (Gemini + IMPI en paralelo)
+ANALISIS_DEADLINE = float(os.environ.get("ANALISIS_DEADLINE", 8))
+# (con gevent los "hilos" son greenlets: caben cientos de esperas por proceso)
+ANALISIS_MAX_HILOS = int(os.environ.get("ANALISIS_MAX_HILOS", 256 if MODO_GEVENT else 16))
+
+# HTTP: conexiones keep-alive por host en cada worker (al menos una por hilo que pueda llamar a la vez)
+HTTP_POOL_MAX = int(os.environ.get("HTTP_POOL_MAX", ANALISIS_MAX_HILOS))
+
+# LOTES (/analizar/lote) y límites de tasa por host externo (peticiones/s por worker).
+# IMPI_TASA solo aplica a las búsquedas de un lote; las de /analizar nunca hacen fila detrás de él
+LOTE_MAX_ITEMS = int(os.environ.get("LOTE_MAX_ITEMS", 500))
+LOTE_CONCURRENCIA = int(os.environ.get("LOTE_CONCURRENCIA", 4))
+IMPI_TASA = float(os.environ.get("IMPI_TASA", 2))
+GEMINI_TASA = float(os.environ.get("GEMINI_TASA", 5))
+
+# PROTECCIÓN IMPI: circuit breaker por tasa de error/latencia y límite adaptativo (AIMD) de concurrencia
+IMPI_CIRCUITO_VENTANA = float(os.environ.get("IMPI_CIRCUITO_VENTANA", 60))
+IMPI_CIRCUITO_MIN_LLAMADAS = int(os.environ.get("IMPI_CIRCUITO_MIN_LLAMADAS", 5))
+IMPI_CIRCUITO_UMBRAL = float(os.environ.get("IMPI_CIRCUITO_UMBRAL", 0.5))
+IMPI_CIRCUITO_LATENCIA = float(os.environ.get("IMPI_CIRCUITO_LATENCIA", 10))
+IMPI_CIRCUITO_ENFRIAMIENTO = float(os.environ.get("IMPI_CIRCUITO_ENFRIAMIENTO", 30))
+IMPI_CONCURRENCIA_MAX = int(os.environ.get("IMPI_CONCURRENCIA_MAX", 8))
+IMPI_LATENCIA_OBJETIVO = float(os.environ.get("IMPI_LATENCIA_OBJETIVO", 3))
+IMPI_CONCURRENCIA_ESPERA = float(os.environ.get("IMPI_CONCURRENCIA_ESPERA", 2))
+
+# COALESCING: espera máxima por el lock entre workers antes de llamar de todos modos
+VUELO_ESPERA_MAX = float(os.environ.get("VUELO_ESPERA_MAX", 35))
+
+# SIMILITUD: cada cuánto (s) revisar si el espejo local cambió para recargar el corpus
+SIMILITUD_RECARGA = float(os.environ.get("SIMILITUD_RECARGA", 60))
+
+# CACHÉ DE CLASIFICACIONES NIZA (entradas máximas, compartida entre workers)
+CLASES_CACHE_MAX = int(os.environ.get("CLASES_CACHE_MAX", 5000))
+
+# CLASIFICADOR LOCAL: confianza mínima para no consultar a Gemini
+CLASIFICADOR_UMBRAL = float(os.environ.get("CLASIFICADOR_UMBRAL", 0.6))
+
+# GEMINI: ventana (s) y tamaño máximo de los lotes de clasificación
+GEMINI_LOTE_VENTANA = float(os.environ.get("GEMINI_LOTE_VENTANA", 0.04))
+GEMINI_LOTE_MAX = int(os.environ.get("GEMINI_LOTE_MAX", 10))
+# Llamadas de lote simultáneas; usan hilos propios, nunca el pool de análisis donde esperan los que piden
+GEMINI_LOTE_HILOS = int(os.environ.get("GEMINI_LOTE_HILOS", 4))
+
+# OUTBOX: reintentos de Sheets y notificaciones en segundo plano
+OUTBOX_INTERVALO = float(os.environ.get("OUTBOX_INTERVALO", 2))
+OUTBOX_LEASE = int(os.environ.get("OUTBOX_LEASE", 120))
+# Tareas reclamadas por vuelta; el lease se renueva antes de cada una
+OUTBOX_LOTE = int(os.environ.get("OUTBOX_LOTE", 10))
+OUTBOX_MAX_INTENTOS = int(os.environ.get("OUTBOX_MAX_INTENTOS", 8))
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", 10))
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", 3600))
+
+# SHEETS: filas agrupadas por hoja en una sola llamada a Apps Script. Solo activar cuando el
+# script acepte {'lote': True, 'datos': [...]} y responda {'resultados': [{'ok': ...}, ...]}
+SHEETS_LOTES = os.environ.get("SHEETS_LOTES", "false").lower() == "true"
+SHEETS_LOTE_VENTANA = float(os.environ.get("SHEETS_LOTE_VENTANA", 1.0))
+SHEETS_LOTE_MAX = int(os.environ.get("SHEETS_LOTE_MAX", 25))
+
+# LÍMITE POR CLIENTE: peticiones/minuto por sesión en endpoints caros (0 = sin límite); por IP se multiplica
+LIMITE_ANALIZAR_MINUTO = float(os.environ.get("LIMITE_ANALIZAR_MINUTO", 20))
+LIMITE_LOTE_MINUTO = float(os.environ.get("LIMITE_LOTE_MINUTO", 2))
+LIMITE_DEBUG_MINUTO = float(os.environ.get("LIMITE_DEBUG_MINUTO", 5))
+LIMITE_FACTOR_IP = float(os.environ.get("LIMITE_FACTOR_IP", 3))
+LIMITE_SLOTS = int(os.environ.get("LIMITE_SLOTS", 65536))
+# Proxies de confianza delante de la app (Render: 1); la IP del cliente es la que agregó el más externo
+PROXIES_CONFIABLES = int(os.environ.get("PROXIES_CONFIABLES", 1))
+
+# PÁGINAS: max-age (s) del HTML precomprimido de home y páginas legales
+PAGINAS_MAX_AGE = int(os.environ.get("PAGINAS_MAX_AGE", 300))
+
+# ARRANQUE: calentar cada worker de gunicorn al nacer (Gemini, sesión IMPI, bases y páginas)
+ARRANQUE_CALENTAR = os.environ.get("ARRANQUE_CALENTAR", "true").lower() == "true"
+# Inicio del master de gunicorn (lo fija gunicorn.conf.py); sin él, el inicio de la importación
+ARRANQUE_EPOCH = float(os.environ.get("ARRANQUE_EPOCH") or _INICIO_IMPORTACION)
+
+# MÉTRICAS: cada cuánto (s) vuelca cada worker su instantánea para /metrics
+METRICAS_INTERVALO = float(os.environ.get("METRICAS_INTERVALO", 5))
+
+# LOGS: nivel general, niveles por subsistema ("impi=DEBUG,gemini=WARNING") y fracción de líneas muestreadas
+LOG_NIVEL = os.environ.get("LOG_NIVEL", "INFO").upper()
+LOG_NIVELES = os.environ.get("LOG_NIVELES", "")
+LOG_MUESTREO = float(os.environ.get("LOG_MUESTREO", 0.1))
 
-if API_KEY_GEMINI:
-    genai.configure(api_key=API_KEY_GEMINI)
-    print("✓ Gemini configurado")
-else:
-    print("⚠ API_KEY_GEMINI no encontrada")
+
+# ============================================
+# LOGS ESTRUCTURADOS (JSON, escritos por un hilo aparte)
+# ============================================
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+# Para líneas de alto volumen: solo se escribe una fracción LOG_MUESTREO
+MUESTREADO = {"muestreo": True}
+
+_ATRIBUTOS_REGISTRO = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "muestreo"}
+
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por registro; los `extra` del llamador se agregan como campos"""
+
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created, MEXICO_TZ).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "sub": record.name.rpartition(".")[2],
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        if getattr(record, "request_id", None):
+            datos["request_id"] = record.request_id
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_REGISTRO:
+                datos[clave] = valor
+        if record.exc_info:
+            datos["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            datos["exc"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class _ManejadorCola(logging.handlers.QueueHandler):
+    """Encola registros ya formateados; el hilo escritor se (re)crea en cada proceso"""
+
+    def __init__(self, destino):
+        super().__init__(queue.SimpleQueue())
+        self.destino = destino
+        self._pid = None
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, "muestreo", False) and random.random() >= LOG_MUESTREO:
+            return False
+        # El request-id se toma en el hilo que registra, no en el escritor
+        record.request_id = _request_id.get()
+        return super().filter(record)
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.SimpleQueue()
+                    self._listener = logging.handlers.QueueListener(self.queue, self.destino)
+                    self._listener.start()
+                    self._pid = os.getpid()
+        self.queue.put_nowait(record)
+
+    def prepare(self, record):
+        # Se formatea en el escritor; aquí solo se fijan mensaje y excepción
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def detener(self):
+        """Escribe lo pendiente; si después se registra algo más, el escritor vuelve a arrancar"""
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+                self.destino.flush()
+            self._pid = None
+
+
+def _configurar_logs():
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON())
+    manejador = _ManejadorCola(salida)
+
+    raiz = logging.getLogger("marcasegura")
+    raiz.setLevel(LOG_NIVEL)
+    raiz.propagate = False
+    raiz.addHandler(manejador)
+
+    niveles = {}
+    if DEBUG_IMPI:
+        niveles["impi"] = "DEBUG"
+    for par in LOG_NIVELES.split(","):
+        subsistema, _, nivel = par.partition("=")
+        if subsistema.strip() and nivel.strip():
+            niveles[subsistema.strip()] = nivel.strip().upper()
+    for subsistema, nivel in niveles.items():
+        logging.getLogger(f"marcasegura.{subsistema}").setLevel(nivel)
+
+    atexit.register(manejador.detener)
+
+
+def obtener_logger(subsistema):
+    return logging.getLogger(f"marcasegura.{subsistema}")
+
+
+def vaciar_logs():
+    """Antes de un fork: que los workers no hereden líneas sin escribir (saldrían duplicadas)"""
+    for manejador in logging.getLogger("marcasegura").handlers:
+        if isinstance(manejador, _ManejadorCola):
+            manejador.detener()
+
+
+_configurar_logs()
+log_app = obtener_logger("app")
+log_analisis = obtener_logger("analisis")
+log_impi = obtener_logger("impi")
+log_gemini = obtener_logger("gemini")
+log_niza = obtener_logger("niza")
+log_cache = obtener_logger("cache")
+log_espejo = obtener_logger("espejo")
+log_sheets = obtener_logger("sheets")
+log_push = obtener_logger("push")
+log_email = obtener_logger("email")
+log_outbox = obtener_logger("outbox")
+log_proteccion = obtener_logger("proteccion")
+
+
+if not API_KEY_GEMINI:
+    log_app.warning("⚠ API_KEY_GEMINI no encontrada")
+
+_gemini_modelo = None
+_gemini_pid = None
+_gemini_lock = threading.Lock()
+
+
+def modelo_gemini():
+    """Configura Gemini y crea el modelo una vez por proceso (en el primer uso o al calentar el worker)"""
+    global _gemini_modelo, _gemini_pid
+    if _gemini_pid != os.getpid():
+        with _gemini_lock:
+            if _gemini_pid != os.getpid():
+                # gRPC no coopera con gevent; por REST las llamadas pasan por el socket parcheado
+                if GEMINI_ENDPOINT:
+                    genai.configure(api_key=API_KEY_GEMINI, transport="rest", client_options={"api_endpoint": GEMINI_ENDPOINT})
+                else:
+                    genai.configure(api_key=API_KEY_GEMINI, transport="rest" if MODO_GEVENT else None)
+                _gemini_modelo = genai.GenerativeModel('gemini-2.0-flash')
+                _gemini_pid = os.getpid()
+                log_gemini.info("✓ Gemini configurado")
+    return _gemini_modelo
 
 # Diccionario completo de Clases de Niza
 CLASES_NIZA = {
@@ -188,26 +521,27 @@ Descripcion: {datos_lead.get('descripcion', 'N/A')}
 Clase: {datos_lead.get('clase_sugerida', 'N/A')}
 Status: {datos_lead.get('status_impi', 'N/A')}"""
 
-        response = requests.post(
-            f"https://ntfy.sh/{NTFY_CHANNEL}",
-            data=mensaje.encode('utf-8'),
-            headers={
-                "Title": titulo.encode('utf-8'),
-                "Priority": "high",
-                "Tags": "briefcase,dollar",
-                "Icon": "https://consultor-marcas-publica.onrender.com/static/logo.png"
-            },
-            timeout=10
-        )
+        with metricas.medir('push') as medicion:
+            response = http_compartido().post(
+                f"{NTFY_URL}/{NTFY_CHANNEL}",
+                data=mensaje.encode('utf-8'),
+                headers={
+                    "Title": titulo.encode('utf-8'),
+                    "Priority": "high",
+                    "Tags": "briefcase,dollar",
+                    "Icon": "https://consultor-marcas-publica.onrender.com/static/logo.png"
+                }
+            )
+            medicion.ok = response.status_code == 200
         
         if response.status_code == 200:
-            print(f"[PUSH] ✓ Notificación enviada")
+            log_push.info("✓ Notificación enviada")
             return True
         else:
-            print(f"[PUSH] ✗ Error: {response.status_code}")
+            log_push.error(f"✗ Error: {response.status_code}")
             return False
     except Exception as e:
-        print(f"[PUSH] ✗ Error: {e}")
+        log_push.error(f"✗ Error: {e}")
         return False
 
 
@@ -225,54 +559,63 @@ Factura: {datos_facturacion.get('requiere_factura', 'No')}"""
 RFC: {datos_facturacion.get('rfc', 'N/A')}
 Razon Social: {datos_facturacion.get('razon_social', 'N/A')}"""
 
-        response = requests.post(
-            f"https://ntfy.sh/{NTFY_CHANNEL}",
-            data=mensaje.encode('utf-8'),
-            headers={
-                "Title": titulo.encode('utf-8'),
-                "Priority": "urgent",
-                "Tags": "white_check_mark,moneybag",
-                "Icon": "https://consultor-marcas-publica.onrender.com/static/logo.png"
-            },
-            timeout=10
-        )
+        with metricas.medir('push') as medicion:
+            response = http_compartido().post(
+                f"{NTFY_URL}/{NTFY_CHANNEL}",
+                data=mensaje.encode('utf-8'),
+                headers={
+                    "Title": titulo.encode('utf-8'),
+                    "Priority": "urgent",
+                    "Tags": "white_check_mark,moneybag",
+                    "Icon": "https://consultor-marcas-publica.onrender.com/static/logo.png"
+                }
+            )
+            medicion.ok = response.status_code == 200
         
         if response.status_code == 200:
-            print(f"[PUSH PAGO] ✓ Notificación enviada")
+            log_push.info("✓ Notificación de pago enviada")
             return True
         else:
-            print(f"[PUSH PAGO] ✗ Error: {response.status_code}")
+            log_push.error(f"✗ Error en notificación de pago: {response.status_code}")
             return False
     except Exception as e:
-        print(f"[PUSH PAGO] ✗ Error: {e}")
+        log_push.error(f"✗ Error en notificación de pago: {e}")
         return False
 
 
-@lru_cache(maxsize=100)
 def clasificar_con_gemini(descripcion, tipo_negocio):
-    """Usa Gemini para determinar la clase de Niza"""
-    if not API_KEY_GEMINI:
-        return {
-            "clase_principal": "35",
-            "clase_nombre": obtener_nombre_clase("35"),
-            "clases_adicionales": [],
-            "nota": "IA no disponible"
-        }
+    """Usa Gemini para determinar la clase de Niza (con caché persistente compartida)"""
+    # Primero el clasificador local; Gemini solo si la confianza es baja
+    local, confianza = clasificador_niza.clasificar(descripcion, tipo_negocio)
+    if local is not None and confianza >= CLASIFICADOR_UMBRAL:
+        log_niza.debug(f"✓ Clase {local['clase_principal']} (confianza {confianza})", extra=MUESTREADO)
+        metricas.contar('clasificacion', origen='local')
+        return local
     
-    try:
-        # CORREGIDO: Usar modelo actual gemini-2.0-flash
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        prompt = f"""Eres un experto en clasificación de marcas según el sistema de Niza.
+    clave = clave_clasificacion(descripcion, tipo_negocio)
+    cacheado = cache_clases_obtener(clave)
+    if cacheado is not None:
+        metricas.contar('clasificacion', origen='cache')
+        return cacheado
+    
+    # Peticiones simultáneas equivalentes comparten una sola llamada a Gemini
+    return vuelos_gemini.ejecutar(
+        clave,
+        lambda: _clasificar_y_guardar(descripcion, tipo_negocio, clave),
+        revisar=lambda: cache_clases_obtener(clave, contar=False),
+    )
 
-Clasifica este negocio: "{descripcion}" (Tipo: {tipo_negocio})
 
-INSTRUCCIONES:
-- Responde ÚNICAMENTE con el formato: NÚMERO|NOMBRE_CLASE|NOTA_BREVE
-- El NÚMERO debe ser entre 1 y 45
-- No incluyas explicaciones adicionales
+def _clasificar_y_guardar(descripcion, tipo_negocio, clave):
+    resultado, autoritativo = _consultar_gemini(descripcion, tipo_negocio)
+    metricas.contar('clasificacion', origen='gemini' if autoritativo else 'respaldo')
+    # Las clasificaciones de respaldo nunca se guardan como si vinieran de Gemini
+    if autoritativo:
+        cache_clases_guardar(clave, resultado)
+    return resultado
+
 
-EJEMPLOS DE RESPUESTA CORRECTA:
+_GUIA_CLASES_GEMINI = """EJEMPLOS DE RESPUESTA CORRECTA:
 45|Servicios jurídicos|Registro de marcas y patentes
 43|Restaurantes y cafeterías|Servicios de alimentación
 25|Prendas de vestir|Ropa y calzado
@@ -298,125 +641,474 @@ GUÍA RÁPIDA DE CLASES:
 - Transporte/logística/almacenamiento = 39
 - Construcción/reparación/instalación = 37
 - Telecomunicaciones = 38
-- Seguros/finanzas/bienes raíces = 36
+- Seguros/finanzas/bienes raíces = 36"""
+
+
+def _prompt_gemini(descripcion, tipo_negocio):
+    return f"""Eres un experto en clasificación de marcas según el sistema de Niza.
+
+Clasifica este negocio: "{descripcion}" (Tipo: {tipo_negocio})
+
+INSTRUCCIONES:
+- Responde ÚNICAMENTE con el formato: NÚMERO|NOMBRE_CLASE|NOTA_BREVE
+- El NÚMERO debe ser entre 1 y 45
+- No incluyas explicaciones adicionales
+
+{_GUIA_CLASES_GEMINI}
 
 Responde ahora:"""
 
+
+def _prompt_gemini_lote(items):
+    negocios = "\n".join(
+        f'{i}. "{descripcion}" (Tipo: {tipo_negocio})' for i, (descripcion, tipo_negocio) in enumerate(items, start=1)
+    )
+    return f"""Eres un experto en clasificación de marcas según el sistema de Niza.
+
+Clasifica cada uno de estos {len(items)} negocios:
+{negocios}
+
+INSTRUCCIONES:
+- Responde con UNA línea por negocio, en el mismo orden, con el formato: N) NÚMERO|NOMBRE_CLASE|NOTA_BREVE
+- N es el número del negocio en la lista; el NÚMERO de clase debe ser entre 1 y 45
+- No incluyas explicaciones adicionales
+
+{_GUIA_CLASES_GEMINI}
+
+Responde ahora:"""
+
+
+def _parsear_respuesta_gemini(text):
+    """Valida una respuesta NÚMERO|NOMBRE_CLASE|NOTA_BREVE; ValueError si no hay clase"""
+    # Limpiar respuesta de posibles formatos markdown
+    text = text.replace('```', '').strip()
+    
+    if '|' in text:
+        partes = text.split('|')
+        if len(partes) >= 2:
+            clase = partes[0].strip()
+            nombre = partes[1].strip() if len(partes) > 1 else ""
+            nota = partes[2].strip() if len(partes) > 2 else nombre
+            
+            match = re.search(r'\d+', clase)
+            clase_num = match.group() if match else clase
+            
+            # Validar que sea un número válido de clase (1-45)
+            try:
+                clase_int = int(clase_num)
+                if clase_int < 1 or clase_int > 45:
+                    raise ValueError("Clase fuera de rango")
+            except:
+                clase_num = "35"  # Default a servicios comerciales
+                nombre = obtener_nombre_clase("35")
+            
+            log_gemini.info(f"✓ Clase: {clase_num} - {nombre}")
+            return {
+                "clase_principal": clase_num,
+                "clase_nombre": nombre if nombre else obtener_nombre_clase(clase_num),
+                "clases_adicionales": [],
+                "nota": nota
+            }
+    
+    # Fallback: buscar números en la respuesta
+    numeros = re.findall(r'\b\d{1,2}\b', text)
+    if numeros:
+        clase_num = numeros[0]
+        if 1 <= int(clase_num) <= 45:
+            clase_nombre = obtener_nombre_clase(clase_num)
+            log_gemini.warning(f"⚠ Clase extraída: {clase_num} - {clase_nombre}")
+            return {
+                "clase_principal": clase_num,
+                "clase_nombre": clase_nombre,
+                "clases_adicionales": [],
+                "nota": text[:100]
+            }
+    
+    raise ValueError("No se pudo extraer clase")
+
+
+_RE_LINEA_LOTE_GEMINI = re.compile(r'^\s*\**\s*(\d+)\s*[\).:\-]\s*(.+)$')
+
+
+def _generar_gemini(prompt, max_output_tokens):
+    """Una llamada a gemini-2.0-flash (respeta el límite de tasa); devuelve el texto"""
+    model = modelo_gemini()
+    if not limite_gemini.adquirir():
+        raise RuntimeError("Límite de tasa de Gemini alcanzado")
+    with metricas.medir('gemini'):
         response = model.generate_content(
             prompt,
             generation_config=genai.GenerationConfig(
                 temperature=0.1,
-                max_output_tokens=100,
+                max_output_tokens=max_output_tokens,
             )
         )
-        
         text = response.text.strip()
-        print(f"[GEMINI DEBUG] Respuesta: {text}")
-        
-        # Limpiar respuesta de posibles formatos markdown
-        text = text.replace('```', '').strip()
-        
-        if '|' in text:
-            partes = text.split('|')
-            if len(partes) >= 2:
-                clase = partes[0].strip()
-                nombre = partes[1].strip() if len(partes) > 1 else ""
-                nota = partes[2].strip() if len(partes) > 2 else nombre
-                
-                match = re.search(r'\d+', clase)
-                clase_num = match.group() if match else clase
-                
-                # Validar que sea un número válido de clase (1-45)
-                try:
-                    clase_int = int(clase_num)
-                    if clase_int < 1 or clase_int > 45:
-                        raise ValueError("Clase fuera de rango")
-                except:
-                    clase_num = "35"  # Default a servicios comerciales
-                    nombre = obtener_nombre_clase("35")
-                
-                print(f"[GEMINI] ✓ Clase: {clase_num} - {nombre}")
-                return {
-                    "clase_principal": clase_num,
-                    "clase_nombre": nombre if nombre else obtener_nombre_clase(clase_num),
-                    "clases_adicionales": [],
-                    "nota": nota
-                }
-        
-        # Fallback: buscar números en la respuesta
-        numeros = re.findall(r'\b\d{1,2}\b', text)
-        if numeros:
-            clase_num = numeros[0]
-            if 1 <= int(clase_num) <= 45:
-                clase_nombre = obtener_nombre_clase(clase_num)
-                print(f"[GEMINI] ⚠ Clase extraída: {clase_num} - {clase_nombre}")
-                return {
-                    "clase_principal": clase_num,
-                    "clase_nombre": clase_nombre,
-                    "clases_adicionales": [],
-                    "nota": text[:100]
-                }
-        
-        raise ValueError("No se pudo extraer clase")
-        
+    log_gemini.debug(f"Respuesta: {text}", extra=MUESTREADO)
+    return text
+
+
+def _consultar_gemini(descripcion, tipo_negocio):
+    """Llama a Gemini (agrupando con otras peticiones); devuelve (resultado, autoritativo)"""
+    if not API_KEY_GEMINI:
+        return {
+            "clase_principal": "35",
+            "clase_nombre": obtener_nombre_clase("35"),
+            "clases_adicionales": [],
+            "nota": "IA no disponible"
+        }, False
+    
+    try:
+        return loteador_gemini.clasificar(descripcion, tipo_negocio)
     except Exception as e:
-        print(f"[ERROR GEMINI] {e}")
+        log_gemini.error(f"✗ Error: {e}")
         # Clasificación de respaldo basada en palabras clave
-        if tipo_negocio.lower() == 'producto':
-            if any(kw in descripcion.lower() for kw in ['bebida', 'refresco', 'agua', 'jugo']):
-                return {"clase_principal": "32", "clase_nombre": obtener_nombre_clase("32"), "clases_adicionales": [], "nota": "Clasificación automática"}
-            elif any(kw in descripcion.lower() for kw in ['comida', 'alimento', 'snack']):
-                return {"clase_principal": "29", "clase_nombre": obtener_nombre_clase("29"), "clases_adicionales": [], "nota": "Clasificación automática"}
-            elif any(kw in descripcion.lower() for kw in ['ropa', 'vestido', 'calzado']):
-                return {"clase_principal": "25", "clase_nombre": obtener_nombre_clase("25"), "clases_adicionales": [], "nota": "Clasificación automática"}
-            elif any(kw in descripcion.lower() for kw in ['software', 'app', 'programa', 'tecnolog']):
-                return {"clase_principal": "9", "clase_nombre": obtener_nombre_clase("9"), "clases_adicionales": [], "nota": "Clasificación automática"}
-            return {"clase_principal": "1", "clase_nombre": obtener_nombre_clase("1"), "clases_adicionales": [], "nota": "Clasificación por defecto"}
+        return clasificar_por_palabras_clave(descripcion, tipo_negocio), False
+
+
+class LoteadorGemini:
+    """Junta las clasificaciones pendientes durante unos milisegundos y las manda en un solo prompt"""
+
+    def __init__(self, ventana, maximo, hilos):
+        self.ventana = ventana
+        self.maximo = maximo
+        self.hilos = hilos
+        self._cond = threading.Condition()
+        self._pendientes = []
+        self._ejecutor = None
+        self._pid = None
+
+    def clasificar(self, descripcion, tipo_negocio, timeout=60):
+        # Dentro de /analizar no tiene caso esperar más allá del deadline del análisis
+        limite = limite_analisis.get()
+        if limite is not None:
+            timeout = min(timeout, max(0.0, limite - time.monotonic()))
+        futuro = Future()
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pendientes = []
+                self._ejecutor = ThreadPoolExecutor(max_workers=self.hilos, thread_name_prefix="gemini-lotes")
+                threading.Thread(target=self._bucle, name="gemini-lotes", daemon=True).start()
+            self._pendientes.append((descripcion, tipo_negocio, futuro))
+            self._cond.notify()
+        return futuro.result(timeout=timeout)
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                while not self._pendientes:
+                    self._cond.wait()
+                limite = time.monotonic() + self.ventana
+                while len(self._pendientes) < self.maximo:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._cond.wait(restante)
+                lote = self._pendientes[:self.maximo]
+                self._pendientes = self._pendientes[self.maximo:]
+            # La llamada corre aparte para seguir juntando el siguiente lote; en el pool de análisis
+            # podría no haber hilo libre, porque ahí mismo están bloqueados quienes esperan este lote
+            self._ejecutor.submit(self._procesar, lote)
+
+    def _procesar(self, lote):
+        try:
+            if len(lote) == 1:
+                descripcion, tipo_negocio, futuro = lote[0]
+                texto = _generar_gemini(_prompt_gemini(descripcion, tipo_negocio), 100)
+                respuestas = {1: texto}
+            else:
+                log_gemini.info(f"Lote de {len(lote)} clasificaciones")
+                texto = _generar_gemini(_prompt_gemini_lote([(d, t) for d, t, _ in lote]), 60 * len(lote))
+                respuestas = {}
+                for linea in texto.replace('```', '').splitlines():
+                    match = _RE_LINEA_LOTE_GEMINI.match(linea)
+                    if match:
+                        respuestas.setdefault(int(match.group(1)), match.group(2))
+        except Exception as e:
+            for _, _, futuro in lote:
+                futuro.set_exception(e)
+            return
+
+        # Validación y respaldo por elemento, igual que con una sola descripción
+        for i, (descripcion, tipo_negocio, futuro) in enumerate(lote, start=1):
+            try:
+                if i not in respuestas:
+                    raise ValueError(f"Sin respuesta para el elemento {i}")
+                futuro.set_result((_parsear_respuesta_gemini(respuestas[i]), True))
+            except Exception as e:
+                log_gemini.error(f"✗ Error: {e}")
+                futuro.set_result((clasificar_por_palabras_clave(descripcion, tipo_negocio), False))
+
+
+loteador_gemini = LoteadorGemini(GEMINI_LOTE_VENTANA, GEMINI_LOTE_MAX, GEMINI_LOTE_HILOS)
+
+
+def clasificar_por_palabras_clave(descripcion, tipo_negocio):
+    """Clasificación de respaldo basada en palabras clave (sin IA)"""
+    puntajes, _ = clasificador_niza.puntuar(descripcion, tipo_negocio)
+    if not puntajes:
+        clase = "1" if tipo_negocio.lower() == 'producto' else "35"
+        return {"clase_principal": clase, "clase_nombre": obtener_nombre_clase(clase), "clases_adicionales": [], "nota": "Clasificación por defecto"}
+    return clasificador_niza.resultado(puntajes, "Clasificación automática")
+
+
+# ============================================
+# CLASIFICADOR NIZA LOCAL (diccionario de términos precompilado)
+# ============================================
+
+class ClasificadorNiza:
+    """Clasifica descripciones con el diccionario de data/terminos_niza.json.
+
+    Une n-gramas de la descripción normalizada (el más largo primero, con
+    singular de respaldo), suma los pesos por clase con un factor según el
+    tipo (producto/servicio) y calcula una confianza entre 0 y 1.
+    """
+
+    PESO_PLENO = 2.0
+    FACTOR_OTRO_TIPO = 0.35
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._indice = None
+        self._tipos = {}
+        self._max_ngrama = 1
+        self._lock = threading.Lock()
+
+    def _compilar(self):
+        with self._lock:
+            if self._indice is not None:
+                return
+            with open(self.ruta, encoding='utf-8') as f:
+                artefacto = json.load(f)
+            indice = {}
+            for clase, datos in artefacto['clases'].items():
+                self._tipos[clase] = datos['tipo']
+                for termino, peso in datos['terminos'].items():
+                    termino = normalizar_denominacion(termino)
+                    indice.setdefault(termino, []).append((clase, float(peso)))
+                    self._max_ngrama = max(self._max_ngrama, termino.count(' ') + 1)
+            self._indice = indice
+
+    def _buscar_termino(self, palabras):
+        frase = ' '.join(palabras)
+        encontrado = self._indice.get(frase)
+        if encontrado is None and len(palabras) == 1:
+            if frase.endswith('es'):
+                encontrado = self._indice.get(frase[:-2])
+            if encontrado is None and frase.endswith('s'):
+                encontrado = self._indice.get(frase[:-1])
+        return encontrado
+
+    def puntuar(self, descripcion, tipo_negocio):
+        """Devuelve ([(clase, puntaje)] de mayor a menor, confianza)"""
+        if self._indice is None:
+            self._compilar()
+        palabras = normalizar_denominacion(descripcion).split()
+        tipo = 'producto' if tipo_negocio.lower() == 'producto' else 'servicio'
+        puntajes = {}
+        i = 0
+        while i < len(palabras):
+            for n in range(min(self._max_ngrama, len(palabras) - i), 0, -1):
+                encontrado = self._buscar_termino(palabras[i:i + n])
+                if encontrado:
+                    for clase, peso in encontrado:
+                        factor = 1.0 if self._tipos[clase] == tipo else self.FACTOR_OTRO_TIPO
+                        puntajes[clase] = puntajes.get(clase, 0.0) + peso * factor
+                    i += n
+                    break
+            else:
+                i += 1
+
+        if not puntajes:
+            return [], 0.0
+        ordenados = sorted(puntajes.items(), key=lambda p: p[1], reverse=True)
+        mejor = ordenados[0][1]
+        confianza = (mejor / sum(puntajes.values())) * min(1.0, mejor / self.PESO_PLENO)
+        return ordenados, round(confianza, 3)
+
+    def resultado(self, puntajes, nota):
+        """Arma el dict de clasificación a partir de los puntajes"""
+        clase, mejor = puntajes[0]
+        adicionales = [c for c, p in puntajes[1:3] if p >= mejor * 0.5]
+        return {
+            "clase_principal": clase,
+            "clase_nombre": obtener_nombre_clase(clase),
+            "clases_adicionales": adicionales,
+            "nota": nota,
+        }
+
+    def clasificar(self, descripcion, tipo_negocio):
+        """(resultado o None, confianza) para usar antes de Gemini"""
+        puntajes, confianza = self.puntuar(descripcion, tipo_negocio)
+        if not puntajes:
+            return None, 0.0
+        return self.resultado(puntajes, "Clasificación local"), confianza
+
+
+clasificador_niza = ClasificadorNiza(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'terminos_niza.json'))
+
+
+# ============================================
+# CLIENTE HTTP COMPARTIDO (keep-alive por host)
+# ============================================
+
+class _ConexionHTTPContada(urllib3.connection.HTTPConnection):
+    def connect(self):
+        super().connect()
+        metricas.contar('http_conexiones', host=self.host)
+
+
+class _ConexionHTTPSContada(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        metricas.contar('http_conexiones', host=self.host)
+
+
+class _PoolHTTPContado(urllib3.HTTPConnectionPool):
+    ConnectionCls = _ConexionHTTPContada
+
+
+class _PoolHTTPSContado(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _ConexionHTTPSContada
+
+
+class AdaptadorCompartido(HTTPAdapter):
+    """HTTPAdapter con timeout por defecto del host y conteo de peticiones vs. conexiones nuevas.
+
+    Se comparte entre sesiones (p. ej. las de IMPI, que solo necesitan cookies propias), así
+    que close() no cierra el pool: vive lo mismo que el proceso.
+    """
+
+    def __init__(self, timeout, reintentos_conexion):
+        self.timeout = timeout
+        super().__init__(
+            pool_connections=4,
+            pool_maxsize=HTTP_POOL_MAX,
+            max_retries=Retry(total=reintentos_conexion, connect=reintentos_conexion, read=0, status=0,
+                              redirect=5, backoff_factor=0.2, raise_on_status=False),
+        )
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _PoolHTTPContado, 'https': _PoolHTTPSContado}
+
+    def send(self, request, timeout=None, **kwargs):
+        metricas.contar('http_peticiones', host=urlsplit(request.url).hostname or '')
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+    def close(self):
+        pass
+
+
+# prefijo de URL -> ((timeout conexión, timeout lectura), reintentos de conexión).
+# Solo se reintenta el connect: los POST no son idempotentes y el outbox ya reintenta la entrega.
+_POLITICAS_HTTP = {
+    NTFY_URL: ((3.05, 10), 2),
+    GOOGLE_APPS_SCRIPT_URL: ((5, 30), 2),
+    IMPI_ORIGEN: ((5, 30), 1),
+}
+_POLITICA_HTTP_DEFECTO = ((5, 30), 1)
+
+_http_lock = threading.Lock()
+_http_pid = None
+_http_adaptadores = {}
+_http_sesion = None
+
+
+def _adaptadores_http():
+    """Adaptadores del proceso por prefijo (se recrean tras un fork: los sockets no se heredan)"""
+    global _http_pid, _http_adaptadores, _http_sesion
+    with _http_lock:
+        if _http_pid != os.getpid():
+            _http_adaptadores = {
+                prefijo: AdaptadorCompartido(timeout, reintentos)
+                for prefijo, (timeout, reintentos) in _POLITICAS_HTTP.items() if prefijo
+            }
+            _http_adaptadores[''] = AdaptadorCompartido(*_POLITICA_HTTP_DEFECTO)
+            _http_sesion = None
+            _http_pid = os.getpid()
+        return _http_adaptadores
+
+
+def montar_adaptadores_http(sesion):
+    """Monta en `sesion` los pools compartidos del proceso"""
+    for prefijo, adaptador in _adaptadores_http().items():
+        if prefijo:
+            sesion.mount(prefijo, adaptador)
         else:
-            if any(kw in descripcion.lower() for kw in ['restaurante', 'cafetería', 'bar', 'comida', 'café']):
-                return {"clase_principal": "43", "clase_nombre": obtener_nombre_clase("43"), "clases_adicionales": [], "nota": "Clasificación automática"}
-            elif any(kw in descripcion.lower() for kw in ['software', 'desarrollo', 'tecnolog', 'it', 'sistemas']):
-                return {"clase_principal": "42", "clase_nombre": obtener_nombre_clase("42"), "clases_adicionales": [], "nota": "Clasificación automática"}
-            return {"clase_principal": "35", "clase_nombre": obtener_nombre_clase("35"), "clases_adicionales": [], "nota": "Clasificación por defecto"}
+            sesion.mount('http://', adaptador)
+            sesion.mount('https://', adaptador)
+    return sesion
 
 
-def buscar_impi_simple(marca):
-    """Búsqueda en IMPI usando JSF/PrimeFaces AJAX"""
-    session_req = requests.Session()
-    session_req.headers.update({
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-        'Accept-Language': 'es-MX,es;q=0.9,en;q=0.8',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Connection': 'keep-alive',
-    })
-    
-    marca_buscar = normalizar_marca(marca)
-    
-    print(f"\n{'='*60}")
-    print(f"[IMPI] Buscando marca: '{marca_buscar}'")
-    print(f"{'='*60}")
-    
-    try:
-        # PASO 1: Obtener ViewState
-        url_base = "https://acervomarcas.impi.gob.mx:8181/marcanet/"
-        response_inicial = session_req.get(url_base, timeout=30, verify=True)
-        
+def http_compartido():
+    """Sesión requests del proceso para ntfy, Apps Script y demás llamadas sin estado"""
+    global _http_sesion
+    _adaptadores_http()
+    if _http_sesion is None:
+        sesion = montar_adaptadores_http(requests.Session())
+        with _http_lock:
+            if _http_sesion is None:
+                _http_sesion = sesion
+    return _http_sesion
+
+
+# ============================================
+# SESIONES IMPI (JSF/PrimeFaces) REUTILIZABLES
+# ============================================
+
+_CABECERAS_IMPI = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    'Accept-Language': 'es-MX,es;q=0.9,en;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+}
+
+_RE_VIEWSTATE_PARCIAL = re.compile(
+    r'<update id="[^"]*javax\.faces\.ViewState[^"]*"><!\[CDATA\[(.*?)\]\]></update>', re.S
+)
+
+
+class SesionIMPI:
+    """Sesión HTTP con cookies y ViewState vigentes de marcanet"""
+
+    def __init__(self):
+        # Cookies propias por sesión JSF; las conexiones salen del pool compartido del proceso
+        self.http = montar_adaptadores_http(requests.Session())
+        self.http.headers.update(_CABECERAS_IMPI)
+        self.viewstate = None
+        self.ultimo_uso = 0.0
+
+    def vigente(self):
+        return bool(self.viewstate) and (time.time() - self.ultimo_uso) < IMPI_SESION_TTL
+
+    def renovar(self):
+        """Descarga la página inicial y obtiene un ViewState nuevo"""
+        self.http.cookies.clear()
+        self.viewstate = None
+        with metricas.medir('impi_viewstate') as medicion:
+            response_inicial = self.http.get(IMPI_URL_BASE, verify=True)
+            medicion.ok = response_inicial.status_code == 200
+
         if response_inicial.status_code != 200:
-            print(f"[IMPI] ✗ Error: {response_inicial.status_code}")
-            return "ERROR_CONEXION"
-        
-        soup_inicial = BeautifulSoup(response_inicial.text, 'html.parser')
+            log_impi.error(f"✗ Error: {response_inicial.status_code}")
+            return False
+
+        soup_inicial = bs4.BeautifulSoup(response_inicial.text, 'html.parser')
         viewstate_input = soup_inicial.find('input', {'name': 'javax.faces.ViewState'})
-        
+
         if not viewstate_input:
-            return "ERROR_CONEXION"
-        
-        viewstate = viewstate_input.get('value', '')
-        
-        # PASO 2: Búsqueda AJAX
-        url_busqueda = "https://acervomarcas.impi.gob.mx:8181/marcanet/vistas/common/home.pgi"
-        
+            return False
+
+        self.viewstate = viewstate_input.get('value', '')
+        self.ultimo_uso = time.time()
+        log_impi.debug("ViewState renovado")
+        return True
+
+    def buscar(self, marca_buscar):
+        """POST AJAX de búsqueda por denominación con el ViewState actual"""
         data_busqueda = {
             'javax.faces.partial.ajax': 'true',
             'javax.faces.source': 'frmBsqDen:busquedaIdButton',
@@ -425,87 +1117,1451 @@ def buscar_impi_simple(marca):
             'frmBsqDen:busquedaIdButton': 'frmBsqDen:busquedaIdButton',
             'frmBsqDen': 'frmBsqDen',
             'frmBsqDen:denominacionId': marca_buscar,
-            'javax.faces.ViewState': viewstate,
+            'javax.faces.ViewState': self.viewstate,
         }
-        
+
         headers_ajax = {
             'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
             'Faces-Request': 'partial/ajax',
             'X-Requested-With': 'XMLHttpRequest',
-            'Origin': 'https://acervomarcas.impi.gob.mx:8181',
-            'Referer': url_base,
+            'Origin': IMPI_ORIGEN,
+            'Referer': IMPI_URL_BASE,
         }
+
+        with metricas.medir('impi_busqueda') as medicion:
+            response = self.http.post(IMPI_URL_BUSQUEDA, data=data_busqueda, headers=headers_ajax)
+            medicion.ok = response.status_code == 200
+        self.ultimo_uso = time.time()
+
+        # JSF puede devolver un ViewState nuevo en la respuesta parcial
+        if response.status_code == 200:
+            match_vs = _RE_VIEWSTATE_PARCIAL.search(response.text)
+            if match_vs:
+                self.viewstate = match_vs.group(1)
+        return response
+
+    def cerrar(self):
+        self.http.close()
+
+
+def viewstate_rechazado(response):
+    """Detecta si el servidor rechazó la sesión o el ViewState"""
+    if response.status_code != 200:
+        return True
+    texto = response.text
+    return (
+        'ViewExpiredException' in texto
+        or '<redirect' in texto
+        or '<partial-response' not in texto
+    )
+
+
+class PoolSesionesIMPI:
+    """Pool de sesiones IMPI calientes, reutilizadas entre búsquedas"""
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self._libres = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def tomar(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Las sesiones no se comparten entre procesos
+                self._libres = []
+                self._pid = os.getpid()
+            while self._libres:
+                sesion = self._libres.pop()
+                if sesion.vigente():
+                    return sesion
+                sesion.cerrar()
+        return SesionIMPI()
+
+    def devolver(self, sesion):
+        with self._lock:
+            if sesion.vigente() and len(self._libres) < self.maximo:
+                self._libres.append(sesion)
+                return
+        sesion.cerrar()
+
+    def descartar(self, sesion):
+        sesion.cerrar()
+
+
+pool_impi = PoolSesionesIMPI(IMPI_POOL_MAX)
+
+
+def buscar_impi_simple(marca):
+    """Búsqueda en IMPI usando JSF/PrimeFaces AJAX"""
+    return buscar_impi_detallado(marca)['status']
+
+
+def buscar_impi_detallado(marca):
+    """Búsqueda en IMPI protegida por el circuit breaker y el límite adaptativo.
+
+    Los rechazos locales (circuito abierto, sin cupo de concurrencia, límite de
+    tasa) llevan sin_consulta=True: el IMPI no llegó a responder nada.
+    """
+    error = {'status': "ERROR_CONEXION", 'total': None, 'registros': []}
+    if not circuito_impi.permitir():
+        log_impi.warning(f"⚡ Circuito abierto, se omite la consulta de '{marca}'", extra=MUESTREADO)
+        return dict(error, sin_consulta=True)
+    if not concurrencia_impi.adquirir(IMPI_CONCURRENCIA_ESPERA):
+        circuito_impi.cancelar()
+        return dict(error, sin_consulta=True)
+    
+    inicio = time.monotonic()
+    tiempos = {'espera_local': 0.0}
+    resultado = error
+    try:
+        resultado = _consultar_impi(marca, tiempos)
+        return resultado
+    finally:
+        # La espera por nuestro propio límite de tasa no es lentitud del IMPI
+        duracion = time.monotonic() - inicio - tiempos['espera_local']
+        if resultado.get('limitado'):
+            # Rechazo local por límite de tasa: no dice nada de la salud del IMPI
+            circuito_impi.cancelar()
+            concurrencia_impi.liberar()
+        else:
+            exito = resultado['status'] != "ERROR_CONEXION"
+            circuito_impi.registrar(exito, duracion)
+            concurrencia_impi.liberar(exito, duracion)
+
+
+def _consultar_impi(marca, tiempos=None):
+    """Búsqueda en IMPI; devuelve {'status', 'total', 'registros'}.
+
+    Dentro de un lote respeta limite_impi; si se pasa `tiempos`, acumula en
+    tiempos['espera_local'] lo que se esperó por él.
+    """
+    marca_buscar = normalizar_marca(marca)
+    
+    log_impi.debug("Buscando marca", extra={"marca": marca_buscar})
+    
+    error = {'status': "ERROR_CONEXION", 'total': None, 'registros': []}
+    sesion = pool_impi.tomar()
+    try:
+        # PASO 1 y 2: Búsqueda AJAX con sesión reutilizada (ViewState solo si hace falta)
+        response_busqueda = None
+        for intento in range(2):
+            if not sesion.vigente() and not sesion.renovar():
+                pool_impi.descartar(sesion)
+                return error
+            
+            inicio_espera = time.monotonic()
+            permitido = not en_lote.get() or limite_impi.adquirir()
+            if tiempos is not None:
+                tiempos['espera_local'] += time.monotonic() - inicio_espera
+            if not permitido:
+                pool_impi.devolver(sesion)
+                return dict(error, limitado=True, sin_consulta=True)
+            response_busqueda = sesion.buscar(marca_buscar)
+            if not viewstate_rechazado(response_busqueda):
+                break
+            log_impi.warning(f"⚠ Sesión rechazada (intento {intento + 1}), renovando ViewState")
+            sesion.viewstate = None
+        else:
+            pool_impi.descartar(sesion)
+            return error
         
-        response_busqueda = session_req.post(url_busqueda, data=data_busqueda, headers=headers_ajax, timeout=30)
-        
-        if response_busqueda.status_code != 200:
-            return "ERROR_CONEXION"
+        pool_impi.devolver(sesion)
+        sesion = None
         
         # PASO 3: Analizar respuesta
-        respuesta_texto = response_busqueda.text
-        texto_lower = respuesta_texto.lower()
-        
-        # Detectar resultados
-        match_total = re.search(r'total de registros\s*=\s*(\d+)', texto_lower)
-        if match_total and int(match_total.group(1)) > 0:
-            print(f"[IMPI] ✗ MARCA ENCONTRADA - {match_total.group(1)} registros")
-            return "REQUIERE_ANALISIS"
+        with metricas.medir('impi_parseo'):
+            resultado = parsear_respuesta_impi(response_busqueda.text)
+        status = status_desde_respuesta_impi(resultado)
         
-        if 'frmBsqDen:resultadoExpediente_data' in respuesta_texto:
-            filas = re.findall(r'ui-datatable-(even|odd)', respuesta_texto)
-            if filas:
-                print(f"[IMPI] ✗ MARCA ENCONTRADA - {len(filas)} filas")
-                return "REQUIERE_ANALISIS"
-        
-        indicadores = ['registro de marca', 'nominativa', 'mixta']
-        if sum(1 for i in indicadores if i in texto_lower) >= 2:
-            if marca_buscar.lower() in texto_lower:
-                print(f"[IMPI] ✗ MARCA ENCONTRADA")
-                return "REQUIERE_ANALISIS"
-        
-        if 'ui-datatable-empty-message' in respuesta_texto:
-            print(f"[IMPI] ✓ MARCA POSIBLEMENTE DISPONIBLE")
-            return "POSIBLEMENTE_DISPONIBLE"
+        if status == "POSIBLEMENTE_DISPONIBLE":
+            log_impi.info("✓ MARCA POSIBLEMENTE DISPONIBLE")
+        elif resultado['registros'] or resultado['total']:
+            log_impi.info(f"✗ MARCA ENCONTRADA - {resultado['total'] or len(resultado['registros'])} registros")
+        else:
+            log_impi.warning("⚠ Respuesta no reconocida, se requiere análisis")
         
-        if len(respuesta_texto) > 5000:
-            return "REQUIERE_ANALISIS"
-        
-        return "REQUIERE_ANALISIS"
+        return {'status': status, 'total': resultado['total'], 'registros': resultado['registros']}
         
     except Exception as e:
-        print(f"[IMPI] Error: {e}")
+        log_impi.error(f"✗ Error: {e}")
+        if sesion is not None:
+            pool_impi.descartar(sesion)
+        return error
+
+
+# ============================================
+# PARSER DE RESPUESTAS IMPI (partial-response de PrimeFaces)
+# ============================================
+
+_RE_UPDATE_CDATA = re.compile(r'<update id="([^"]*)"><!\[CDATA\[')
+
+_RE_TOTAL_REGISTROS = re.compile(r'total de registros\s*=\s*(\d+)', re.I)
+
+_RE_ETIQUETA = re.compile(r'<[^>]*>')
+
+# Encabezado de la tabla de marcanet -> campo del registro
+_COLUMNAS_IMPI = {
+    'denominacion': 'denominacion',
+    'denominación': 'denominacion',
+    'marca': 'denominacion',
+    'expediente': 'expediente',
+    'registro': 'registro',
+    'no. registro': 'registro',
+    'clase': 'clase',
+    'titular': 'titular',
+    'estatus': 'estatus',
+    'status': 'estatus',
+    'situación': 'estatus',
+    'situacion': 'estatus',
+}
+
+CAMPOS_REGISTRO_IMPI = ('denominacion', 'expediente', 'registro', 'clase', 'titular', 'estatus')
+
+
+def _texto_celda_impi(fragmento):
+    if '<' in fragmento:
+        fragmento = _RE_ETIQUETA.sub('', fragmento)
+    texto = fragmento.strip()
+    if '  ' in texto or '\n' in texto or '\t' in texto:
+        texto = ' '.join(texto.split())
+    return html.unescape(texto) if '&' in texto else texto
+
+
+def _tokenizar_tabla_impi(texto, inicio, fin, resultado):
+    """Recorre una sola vez el HTML de un <update> (saltando con str.find entre
+    etiquetas <th>, <tr> y <td>) y llena encabezados, filas, total y vacío"""
+    columnas = resultado['_columnas']
+    filas = resultado['_filas']
+    celdas = None
+
+    # El "Total de registros = N" está en el encabezado, antes de la tabla
+    pos_tabla = texto.find('<table', inicio, fin)
+    if resultado['total'] is None:
+        match_total = _RE_TOTAL_REGISTROS.search(texto, inicio, pos_tabla if pos_tabla >= 0 else fin)
+        if match_total:
+            resultado['total'] = int(match_total.group(1))
+    if pos_tabla < 0:
+        if texto.find('ui-datatable-empty-message', inicio, fin) >= 0:
+            resultado['vacio'] = True
+        return
+
+    pos = pos_tabla
+    while True:
+        i = texto.find('<t', pos, fin)
+        # Un "<t" truncado al final del <update> no es una etiqueta reconocible
+        if i < 0 or i + 4 > fin:
+            break
+        letra, siguiente = texto[i + 2], texto[i + 3]
+        cierre_etiqueta = texto.find('>', i, fin)
+        if cierre_etiqueta < 0:
+            break
+
+        if siguiente != ' ' and siguiente != '>':
+            # <table>, <thead>, <tbody>, <tfoot>, ...
+            pos = cierre_etiqueta + 1
+        elif letra == 'd':
+            fin_celda = texto.find('</td>', cierre_etiqueta, fin)
+            if fin_celda < 0:
+                break
+            if celdas is not None:
+                celda = texto[cierre_etiqueta + 1:fin_celda]
+                if '<' in celda or '&' in celda or '  ' in celda or '\n' in celda:
+                    celda = _texto_celda_impi(celda)
+                celdas.append(celda.strip())
+            pos = fin_celda + 5
+        elif letra == 'r':
+            atributos = texto[i + 3:cierre_etiqueta]
+            if 'ui-datatable-empty-message' in atributos:
+                resultado['vacio'] = True
+                celdas = None
+            elif 'data-ri=' in atributos or 'ui-datatable-even' in atributos or 'ui-datatable-odd' in atributos:
+                celdas = []
+                filas.append(celdas)
+            else:
+                celdas = None
+            pos = cierre_etiqueta + 1
+        elif letra == 'h':
+            fin_celda = texto.find('</th>', cierre_etiqueta, fin)
+            if fin_celda < 0:
+                break
+            columnas.append(_texto_celda_impi(texto[cierre_etiqueta + 1:fin_celda]).lower())
+            pos = fin_celda + 5
+        else:
+            pos = cierre_etiqueta + 1
+
+
+def parsear_respuesta_impi(texto):
+    """Extrae registros tipados del partial-response XML de la búsqueda en marcanet.
+
+    Devuelve {'total', 'registros', 'vacio', 'tabla'}; cada registro tiene
+    denominacion, expediente, registro, clase (int o None), titular y estatus.
+    """
+    resultado = {'total': None, 'registros': [], 'vacio': False, 'tabla': False, '_columnas': [], '_filas': []}
+
+    for m in _RE_UPDATE_CDATA.finditer(texto):
+        if not m.group(1).startswith('frmBsqDen'):
+            continue
+        inicio = m.end()
+        fin = texto.find(']]>', inicio)
+        if fin < 0:
+            fin = len(texto)
+        if texto.find('resultadoExpediente', inicio, fin) >= 0:
+            resultado['tabla'] = True
+        _tokenizar_tabla_impi(texto, inicio, fin, resultado)
+
+    columnas = [_COLUMNAS_IMPI.get(c) for c in resultado.pop('_columnas')]
+    for celdas in resultado.pop('_filas'):
+        if not celdas:
+            continue
+        registro = dict.fromkeys(CAMPOS_REGISTRO_IMPI)
+        for campo, valor in zip(columnas, celdas):
+            if campo and registro[campo] is None:
+                registro[campo] = valor or None
+        clase = registro['clase']
+        registro['clase'] = int(clase) if clase and clase.isdigit() else None
+        resultado['registros'].append(registro)
+
+    return resultado
+
+
+def status_desde_respuesta_impi(resultado):
+    """Traduce el resultado parseado al status que usa el resto de la app"""
+    if resultado['registros'] or (resultado['total'] or 0) > 0:
+        return "REQUIERE_ANALISIS"
+    if resultado['vacio']:
+        return "POSIBLEMENTE_DISPONIBLE"
+    # Respuesta no reconocida: por precaución se pide análisis
+    return "REQUIERE_ANALISIS"
+
+
+# ============================================
+# MÉTRICAS (formato Prometheus, agregadas entre workers)
+# ============================================
+
+_BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Medicion:
+    def __init__(self, metricas, etapa):
+        self.metricas = metricas
+        self.etapa = etapa
+        self.ok = True
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo_excepcion, excepcion, traza):
+        if tipo_excepcion is not None:
+            self.ok = False
+        self.metricas.observar(self.etapa, time.perf_counter() - self._inicio, self.ok)
+        return False
+
+
+class Metricas:
+    """Histogramas por etapa y contadores en memoria del proceso.
+
+    Cada worker vuelca su instantánea en DATA_DIR/metricas/<pid>-<inicio>.json cada
+    METRICAS_INTERVALO segundos; /metrics suma los archivos de todos los workers. Los de
+    workers que ya terminaron se pasan a retirados.json, así un pid reutilizado no pisa
+    los totales de otro proceso y los contadores nunca bajan.
+    """
+
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._histogramas = {}
+        self._contadores = {}
+        self._pid = None
+        self._archivo = None
+
+    def medir(self, etapa):
+        """with metricas.medir('sheets') as m: ...; m.ok = False si la etapa no tuvo éxito"""
+        return _Medicion(self, etapa)
+
+    def observar(self, etapa, segundos, ok=True):
+        clave = (etapa, "ok" if ok else "error")
+        with self._lock:
+            self._asegurar_volcado()
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = [0] * (len(_BUCKETS_LATENCIA) + 2)
+            for i, limite in enumerate(_BUCKETS_LATENCIA):
+                if segundos <= limite:
+                    histograma[i] += 1
+                    break
+            else:
+                histograma[len(_BUCKETS_LATENCIA)] += 1
+            histograma[-1] += segundos
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._asegurar_volcado()
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def _asegurar_volcado(self):
+        if self._pid != os.getpid():
+            # Tras un fork se empieza de cero: lo heredado ya está en el archivo del padre
+            self._pid = os.getpid()
+            self._archivo = f"{self._pid}-{time.time_ns()}.json"
+            self._histogramas = {}
+            self._contadores = {}
+            threading.Thread(target=self._bucle_volcado, name="metricas", daemon=True).start()
+
+    def _bucle_volcado(self):
+        while True:
+            time.sleep(self.intervalo)
+            self.volcar()
+
+    def volcar(self):
+        """Escribe la instantánea del proceso (reemplazo atómico)"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            datos = {
+                "histogramas": [[etapa, resultado, cubetas] for (etapa, resultado), cubetas in self._histogramas.items()],
+                "contadores": [[nombre, dict(etiquetas), valor] for (nombre, etiquetas), valor in self._contadores.items()],
+            }
+            archivo = self._archivo
+        directorio = os.path.join(DATA_DIR, "metricas")
+        try:
+            os.makedirs(directorio, exist_ok=True)
+            _escribir_json_atomico(os.path.join(directorio, archivo), datos)
+        except OSError as e:
+            log_app.error(f"✗ Error al volcar: {e}")
+
+    @staticmethod
+    def _sumar(datos, histogramas, contadores):
+        for etapa, resultado, cubetas in datos.get("histogramas", []):
+            total = histogramas.setdefault((etapa, resultado), [0] * len(cubetas))
+            for i, valor in enumerate(cubetas):
+                total[i] += valor
+        for nombre, etiquetas, valor in datos.get("contadores", []):
+            clave = (nombre, tuple(sorted(etiquetas.items())))
+            contadores[clave] = contadores.get(clave, 0) + valor
+
+    def _vencido(self, nombre, pids_recientes):
+        """Instantánea de un worker que ya no existe (o cuyo pid ya usa otro worker)"""
+        pid, _, inicio = nombre[:-len(".json")].partition("-")
+        if not pid.isdigit() or not inicio.isdigit():
+            return False
+        if pids_recientes.get(pid, inicio) != inicio:
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def _retirar_vencidas(self, directorio):
+        """Pasa las instantáneas de workers terminados a retirados.json (bajo lock entre workers)"""
+        nombres = [os.path.basename(r) for r in glob.glob(os.path.join(directorio, "*-*.json"))]
+        pids_recientes = {}
+        for nombre in nombres:
+            pid, _, inicio = nombre[:-len(".json")].partition("-")
+            if inicio.isdigit() and int(inicio) > int(pids_recientes.get(pid, 0)):
+                pids_recientes[pid] = inicio
+        vencidos = [n for n in nombres if self._vencido(n, pids_recientes)]
+        if not vencidos:
+            return
+        with open(os.path.join(directorio, "retirados.lock"), "a+b") as candado:
+            fcntl.lockf(candado, fcntl.LOCK_EX)
+            ruta_retirados = os.path.join(directorio, "retirados.json")
+            try:
+                with open(ruta_retirados) as f:
+                    retirados = json.load(f)
+            except (OSError, ValueError):
+                retirados = {}
+            histogramas, contadores = {}, {}
+            self._sumar(retirados, histogramas, contadores)
+            # Los ya sumados en una pasada que no alcanzó a borrarlos no se vuelven a sumar
+            incluidos = set(retirados.get("archivos", [])) & set(nombres)
+            for nombre in vencidos:
+                if nombre in incluidos:
+                    continue
+                try:
+                    with open(os.path.join(directorio, nombre)) as f:
+                        self._sumar(json.load(f), histogramas, contadores)
+                except (OSError, ValueError):
+                    continue
+                incluidos.add(nombre)
+            _escribir_json_atomico(ruta_retirados, {
+                "histogramas": [[etapa, resultado, cubetas] for (etapa, resultado), cubetas in histogramas.items()],
+                "contadores": [[nombre, dict(etiquetas), valor] for (nombre, etiquetas), valor in contadores.items()],
+                "archivos": sorted(incluidos),
+            })
+            for nombre in incluidos:
+                try:
+                    os.remove(os.path.join(directorio, nombre))
+                except FileNotFoundError:
+                    pass
+
+    def agregadas(self):
+        """Suma las instantáneas de los workers vivos y los totales de los que ya terminaron"""
+        directorio = os.path.join(DATA_DIR, "metricas")
+        try:
+            self._retirar_vencidas(directorio)
+        except OSError as e:
+            log_app.error(f"✗ Error al retirar instantáneas: {e}")
+        histogramas, contadores = {}, {}
+        for ruta in glob.glob(os.path.join(directorio, "*.json")):
+            try:
+                with open(ruta) as f:
+                    datos = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._sumar(datos, histogramas, contadores)
+        return histogramas, contadores
+
+
+def _escribir_json_atomico(ruta, datos):
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, "w") as f:
+        json.dump(datos, f)
+    os.replace(temporal, ruta)
+
+
+metricas = Metricas(METRICAS_INTERVALO)
+
+
+def _etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ""
+    pares = ",".join(
+        f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in etiquetas
+    )
+    return "{" + pares + "}"
+
+
+def exposicion_prometheus(histogramas, contadores, medidores):
+    """Texto en formato de exposición de Prometheus 0.0.4"""
+    lineas = [
+        "# HELP marcasegura_etapa_segundos Duración de cada etapa (IMPI, Gemini, Sheets, push, email...)",
+        "# TYPE marcasegura_etapa_segundos histogram",
+    ]
+    for (etapa, resultado), cubetas in sorted(histogramas.items()):
+        base = (("etapa", etapa), ("resultado", resultado))
+        acumulado = 0
+        for limite, valor in zip(_BUCKETS_LATENCIA, cubetas):
+            acumulado += valor
+            lineas.append(f"marcasegura_etapa_segundos_bucket{_etiquetas_prometheus(base + (('le', limite),))} {acumulado}")
+        acumulado += cubetas[len(_BUCKETS_LATENCIA)]
+        lineas.append(f"marcasegura_etapa_segundos_bucket{_etiquetas_prometheus(base + (('le', '+Inf'),))} {acumulado}")
+        lineas.append(f"marcasegura_etapa_segundos_sum{_etiquetas_prometheus(base)} {cubetas[-1]:.6f}")
+        lineas.append(f"marcasegura_etapa_segundos_count{_etiquetas_prometheus(base)} {acumulado}")
+
+    nombres = sorted({nombre for nombre, _ in contadores})
+    for nombre in nombres:
+        lineas.append(f"# TYPE marcasegura_{nombre}_total counter")
+        for (n, etiquetas), valor in sorted(contadores.items()):
+            if n == nombre:
+                lineas.append(f"marcasegura_{nombre}_total{_etiquetas_prometheus(etiquetas)} {valor:g}")
+
+    for nombre in sorted({nombre for nombre, _, _ in medidores}):
+        lineas.append(f"# TYPE marcasegura_{nombre} gauge")
+        for n, etiquetas, valor in medidores:
+            if n == nombre:
+                lineas.append(f"marcasegura_{nombre}{_etiquetas_prometheus(etiquetas)} {valor:g}")
+    return "\n".join(lineas) + "\n"
+
+
+# ============================================
+# PERSISTENCIA LOCAL (SQLite)
+# ============================================
+
+if MODO_GEVENT:
+    # threading.local parcheado es por greenlet (una conexión por petición); se comparte la del hilo real.
+    # Es seguro porque ninguna transacción cede el control a otro greenlet antes de terminar.
+    _db_local = _monkey_gevent.get_original("_thread", "_local")()
+else:
+    _db_local = threading.local()
+
+
+def obtener_conexion_db(nombre, esquema="", directorio=None):
+    """Conexión SQLite por hilo y por proceso a un archivo dentro de DATA_DIR (o de `directorio`)"""
+    if getattr(_db_local, 'pid', None) != os.getpid():
+        # Después de un fork las conexiones heredadas no se deben reutilizar
+        _db_local.conexiones = {}
+        _db_local.pid = os.getpid()
+
+    directorio = directorio or DATA_DIR
+    ruta = os.path.join(directorio, nombre)
+    con = _db_local.conexiones.get(ruta)
+    if con is None:
+        os.makedirs(directorio, exist_ok=True)
+        con = sqlite3.connect(ruta, timeout=10, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        if esquema:
+            con.executescript(esquema)
+        _db_local.conexiones[ruta] = con
+    return con
+
+
+# ============================================
+# COALESCING DE LLAMADAS IDÉNTICAS (single-flight)
+# ============================================
+
+_vuelos_archivo = None
+_vuelos_archivo_pid = None
+_vuelos_archivo_lock = threading.Lock()
+
+
+def _archivo_vuelos():
+    """Archivo de locks por rango compartido entre workers (uno abierto por proceso)"""
+    global _vuelos_archivo, _vuelos_archivo_pid
+    with _vuelos_archivo_lock:
+        if _vuelos_archivo is None or _vuelos_archivo_pid != os.getpid():
+            os.makedirs(DATA_DIR, exist_ok=True)
+            _vuelos_archivo = open(os.path.join(DATA_DIR, "vuelos.lock"), "a+b")
+            _vuelos_archivo_pid = os.getpid()
+        return _vuelos_archivo
+
+
+class VueloUnico:
+    """Las llamadas concurrentes con la misma clave comparten una sola ejecución.
+
+    Dentro del proceso los demás hilos esperan el Future del líder. Entre
+    workers, el líder toma un lock fcntl sobre un byte derivado de la clave y,
+    ya con el lock, vuelve a consultar `revisar` (p. ej. la caché compartida)
+    por si otro worker acaba de obtener el resultado.
+    """
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self._lock = threading.Lock()
+        self._en_vuelo = {}
+
+    def ejecutar(self, clave, funcion, revisar=None):
+        with self._lock:
+            futuro = self._en_vuelo.get(clave)
+            lider = futuro is None
+            if lider:
+                futuro = self._en_vuelo[clave] = Future()
+
+        if not lider:
+            log_cache.info("↪ Esperando llamada en curso", extra={"vuelo": self.nombre, "clave": clave})
+            return futuro.result()
+
+        try:
+            resultado = self._ejecutar_entre_workers(clave, funcion, revisar)
+            futuro.set_result(resultado)
+            return resultado
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._en_vuelo[clave]
+
+    def _ejecutar_entre_workers(self, clave, funcion, revisar):
+        if revisar is None:
+            return funcion()
+
+        digest = hashlib.sha1(f"{self.nombre}:{clave}".encode('utf-8')).digest()
+        posicion = int.from_bytes(digest[:4], 'big') & 0x7FFFFFFF
+        archivo = _archivo_vuelos()
+        limite = time.time() + VUELO_ESPERA_MAX
+        bloqueado = False
+        try:
+            while True:
+                try:
+                    fcntl.lockf(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, posicion)
+                    bloqueado = True
+                    break
+                except OSError:
+                    if time.time() >= limite:
+                        break
+                    time.sleep(0.05)
+
+            previo = revisar()
+            if previo is not None:
+                log_cache.info("✓ Resultado de otro worker", extra={"vuelo": self.nombre, "clave": clave})
+                return previo
+            return funcion()
+        finally:
+            if bloqueado:
+                fcntl.lockf(archivo, fcntl.LOCK_UN, 1, posicion)
+
+
+vuelos_impi = VueloUnico("IMPI")
+vuelos_gemini = VueloUnico("GEMINI")
+
+
+# ============================================
+# CACHÉ IMPI (compartida, con stale-while-revalidate)
+# ============================================
+
+_ESQUEMA_CACHE_IMPI = """
+CREATE TABLE IF NOT EXISTS impi_cache (
+    clave TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    creado REAL NOT NULL,
+    fresco_hasta REAL NOT NULL,
+    stale_hasta REAL NOT NULL,
+    refrescando_hasta REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_impi_cache_stale ON impi_cache(stale_hasta);
+"""
+
+_refrescos_impi = set()
+_refrescos_impi_lock = threading.Lock()
+
+
+def _db_cache_impi():
+    return obtener_conexion_db("impi_cache.db", _ESQUEMA_CACHE_IMPI)
+
+
+def _ttl_cache_impi(status):
+    """Devuelve (ttl_fresco, ventana_stale) según el resultado"""
+    if status == "POSIBLEMENTE_DISPONIBLE":
+        return IMPI_CACHE_TTL_DISPONIBLE, IMPI_CACHE_STALE
+    if status == "REQUIERE_ANALISIS":
+        return IMPI_CACHE_TTL_ANALISIS, IMPI_CACHE_STALE
+    # Los errores se guardan poco tiempo y nunca se sirven vencidos
+    return IMPI_CACHE_TTL_ERROR, 0
+
+
+def cache_impi_obtener(clave):
+    """Lee una entrada de la caché IMPI (o None)"""
+    try:
+        fila = _db_cache_impi().execute(
+            "SELECT status, fresco_hasta, stale_hasta FROM impi_cache WHERE clave = ?", (clave,)
+        ).fetchone()
+        return fila
+    except sqlite3.Error as e:
+        log_cache.error(f"✗ Error lectura: {e}", extra={"cache": "impi"})
+        return None
+
+
+def cache_impi_guardar(clave, status):
+    """Guarda un resultado IMPI; un error no reemplaza un resultado bueno vigente"""
+    ahora = time.time()
+    ttl, stale = _ttl_cache_impi(status)
+    try:
+        db = _db_cache_impi()
+        if status == "ERROR_CONEXION":
+            previa = db.execute(
+                "SELECT status, stale_hasta FROM impi_cache WHERE clave = ?", (clave,)
+            ).fetchone()
+            if previa and previa[0] != "ERROR_CONEXION" and previa[1] > ahora:
+                return
+        db.execute(
+            "INSERT OR REPLACE INTO impi_cache (clave, status, creado, fresco_hasta, stale_hasta, refrescando_hasta) "
+            "VALUES (?, ?, ?, ?, ?, 0)",
+            (clave, status, ahora, ahora + ttl, ahora + ttl + stale),
+        )
+        # Limpieza ocasional de entradas completamente vencidas
+        if int(ahora * 1000) % 100 == 0:
+            db.execute("DELETE FROM impi_cache WHERE stale_hasta < ?", (ahora,))
+    except sqlite3.Error as e:
+        log_cache.error(f"✗ Error escritura: {e}", extra={"cache": "impi"})
+
+
+def _reclamar_refresco_impi(clave):
+    """Marca la entrada como 'refrescando' para que solo un worker la actualice"""
+    ahora = time.time()
+    try:
+        cursor = _db_cache_impi().execute(
+            "UPDATE impi_cache SET refrescando_hasta = ? WHERE clave = ? AND refrescando_hasta < ?",
+            (ahora + 120, clave, ahora),
+        )
+        return cursor.rowcount == 1
+    except sqlite3.Error:
+        return False
+
+
+def _refrescar_impi(marca, clave):
+    try:
+        _buscar_y_guardar_impi(marca, clave)
+    finally:
+        with _refrescos_impi_lock:
+            _refrescos_impi.discard(clave)
+
+
+def _programar_refresco_impi(marca, clave):
+    """Lanza en segundo plano la actualización de una entrada vencida"""
+    with _refrescos_impi_lock:
+        if clave in _refrescos_impi:
+            return
+        _refrescos_impi.add(clave)
+    if not _reclamar_refresco_impi(clave):
+        with _refrescos_impi_lock:
+            _refrescos_impi.discard(clave)
+        return
+    log_cache.info(f"↻ Refrescando '{clave}' en segundo plano")
+    threading.Thread(target=_refrescar_impi, args=(marca, clave), daemon=True).start()
+
+
+def buscar_impi_cacheado(marca):
+    """Búsqueda IMPI con caché compartida: fresco → directo, vencido → stale + refresco"""
+    clave = normalizar_marca(marca)
+    entrada = cache_impi_obtener(clave)
+    ahora = time.time()
+
+    if entrada:
+        status, fresco_hasta, stale_hasta = entrada
+        if ahora < fresco_hasta:
+            log_cache.debug(f"✓ Hit IMPI '{clave}': {status}", extra=MUESTREADO)
+            metricas.contar('cache', cache='impi', resultado='fresco')
+            return status
+        if ahora < stale_hasta:
+            log_cache.info(f"⚠ Stale IMPI '{clave}': {status}")
+            metricas.contar('cache', cache='impi', resultado='stale')
+            _programar_refresco_impi(marca, clave)
+            return status
+
+    metricas.contar('cache', cache='impi', resultado='fallo')
+
+    # Con el circuito abierto se responde de inmediato en vez de ocupar un hilo esperando
+    if circuito_impi.abierto():
+        log_impi.warning(f"⚡ Circuito abierto, '{clave}' sin caché", extra=MUESTREADO)
         return "ERROR_CONEXION"
 
+    # Búsquedas simultáneas de la misma marca comparten una sola consulta al IMPI
+    return vuelos_impi.ejecutar(
+        clave,
+        lambda: _buscar_y_guardar_impi(marca, clave),
+        revisar=lambda: _status_fresco_impi(clave),
+    )
+
+
+def _status_fresco_impi(clave):
+    entrada = cache_impi_obtener(clave)
+    if entrada and time.time() < entrada[1]:
+        return entrada[0]
+    return None
+
+
+def _buscar_y_guardar_impi(marca, clave):
+    resultado = buscar_impi_detallado(marca)
+    # Un rechazo local no es un veredicto del IMPI: cachearlo dejaría a todos sin consulta un minuto
+    if not resultado.get('sin_consulta'):
+        cache_impi_guardar(clave, resultado['status'])
+    if resultado['registros']:
+        try:
+            guardar_marcas_locales(resultado['registros'])
+        except sqlite3.Error as e:
+            log_espejo.error(f"✗ Error guardando registros: {e}")
+    return resultado['status']
+
+
+# ============================================
+# CACHÉ DE CLASIFICACIONES NIZA (compartida, LRU)
+# ============================================
+
+_ESQUEMA_CACHE_CLASES = """
+CREATE TABLE IF NOT EXISTS clasificaciones (
+    clave TEXT PRIMARY KEY,
+    resultado TEXT NOT NULL,
+    creado REAL NOT NULL,
+    ultimo_uso REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_clasificaciones_uso ON clasificaciones(ultimo_uso);
+DROP TABLE IF EXISTS contadores;
+"""
+
+_PALABRAS_VACIAS = frozenset("""
+a al algo con de del e el en entre es la las lo los mas mi mis o para pero por que se sin su sus
+tu tus u un una unas uno unos y ya nuestro nuestra nuestros nuestras tipo venta negocio empresa
+""".split())
+
+
+def _db_cache_clases():
+    return obtener_conexion_db("clases_cache.db", _ESQUEMA_CACHE_CLASES)
+
+
+def clave_clasificacion(descripcion, tipo_negocio):
+    """Clave normalizada: minúsculas, sin acentos, sin signos ni palabras vacías"""
+    palabras = [p for p in normalizar_denominacion(descripcion).split() if p not in _PALABRAS_VACIAS]
+    return f"{normalizar_denominacion(tipo_negocio) or 'servicio'}|{' '.join(palabras)}"
+
+
+def cache_clases_obtener(clave, contar=True):
+    """Clasificación guardada para la clave (o None); actualiza el uso para la LRU"""
+    try:
+        db = _db_cache_clases()
+        fila = db.execute(
+            "SELECT resultado, ultimo_uso FROM clasificaciones WHERE clave = ?", (clave,)
+        ).fetchone()
+        ahora = time.time()
+        if fila and ahora - fila[1] > 60:
+            db.execute("UPDATE clasificaciones SET ultimo_uso = ? WHERE clave = ?", (ahora, clave))
+        if contar:
+            # En memoria, como la caché IMPI: un hit no debe costar una escritura en SQLite
+            metricas.contar('cache', cache='niza', resultado='acierto' if fila else 'fallo')
+        if fila:
+            log_cache.debug(f"✓ Hit Niza '{clave}'", extra=MUESTREADO)
+            return json.loads(fila[0])
+    except sqlite3.Error as e:
+        log_cache.error(f"✗ Error lectura: {e}", extra={"cache": "niza"})
+    return None
+
+
+def cache_clases_guardar(clave, resultado):
+    """Guarda una clasificación de Gemini y recorta la caché a CLASES_CACHE_MAX entradas"""
+    ahora = time.time()
+    try:
+        db = _db_cache_clases()
+        db.execute(
+            "INSERT OR REPLACE INTO clasificaciones (clave, resultado, creado, ultimo_uso) VALUES (?, ?, ?, ?)",
+            (clave, json.dumps(resultado, ensure_ascii=False), ahora, ahora),
+        )
+        db.execute(
+            "DELETE FROM clasificaciones WHERE clave IN ("
+            "SELECT clave FROM clasificaciones ORDER BY ultimo_uso DESC LIMIT -1 OFFSET ?)",
+            (CLASES_CACHE_MAX,),
+        )
+    except sqlite3.Error as e:
+        log_cache.error(f"✗ Error escritura: {e}", extra={"cache": "niza"})
+
+
+def estadisticas_cache_clases():
+    """Entradas de la caché de clasificaciones (aciertos y fallos van en /metrics)"""
+    try:
+        db = _db_cache_clases()
+        return {"entradas": db.execute("SELECT COUNT(*) FROM clasificaciones").fetchone()[0]}
+    except sqlite3.Error as e:
+        return {"error": str(e)}
+
+
+# ============================================
+# ESPEJO LOCAL DE MARCAS IMPI (denominación normalizada + clave fonética)
+# ============================================
+
+_ESQUEMA_MARCAS = """
+CREATE TABLE IF NOT EXISTS marcas (
+    id INTEGER PRIMARY KEY,
+    clave TEXT NOT NULL UNIQUE,
+    denominacion TEXT NOT NULL,
+    denominacion_norm TEXT NOT NULL,
+    clave_fonetica TEXT NOT NULL,
+    n_trigramas INTEGER NOT NULL,
+    expediente TEXT,
+    registro TEXT,
+    clase INTEGER,
+    titular TEXT,
+    estatus TEXT,
+    actualizado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_marcas_norm ON marcas(denominacion_norm);
+CREATE INDEX IF NOT EXISTS idx_marcas_fonetica ON marcas(clave_fonetica);
+DROP TABLE IF EXISTS marcas_trigramas;
+"""
+
+# Reglas en orden: se aplican sobre el texto ya normalizado (sin acentos, minúsculas)
+_REGLAS_FONETICAS = [
+    (re.compile(r'ch'), 'X'),
+    (re.compile(r'll'), 'y'),
+    (re.compile(r'qu([ei])'), r'k\1'),
+    (re.compile(r'gu([ei])'), r'g\1'),
+    (re.compile(r'g([ei])'), r'j\1'),
+    (re.compile(r'c([ei])'), r's\1'),
+    (re.compile(r'h'), ''),
+    (re.compile(r'[cq]'), 'k'),
+    (re.compile(r'z'), 's'),
+    (re.compile(r'[vw]'), 'b'),
+    (re.compile(r'x'), 'ks'),
+    (re.compile(r'y(?=[^aeiou]|$)'), 'i'),
+    (re.compile(r'(.)\1+'), r'\1'),
+]
+
+
+def normalizar_denominacion(texto):
+    """Minúsculas, sin acentos ni signos, espacios simples (ñ se conserva)"""
+    texto = texto.lower().replace('ñ', '\x00')
+    texto = unicodedata.normalize('NFKD', texto)
+    texto = ''.join(c for c in texto if not unicodedata.combining(c)).replace('\x00', 'ñ')
+    texto = re.sub(r'[^a-z0-9ñ]+', ' ', texto)
+    return texto.strip()
+
+
+def clave_fonetica(texto):
+    """Clave fonética en español: b/v, c/s/z, ll/y, h muda, qu/k, ge/je, etc."""
+    clave = normalizar_denominacion(texto).replace(' ', '').replace('ñ', 'N')
+    for patron, reemplazo in _REGLAS_FONETICAS:
+        clave = patron.sub(reemplazo, clave)
+    return clave
+
+
+def trigramas(texto_norm):
+    """Conjunto de trigramas de la denominación normalizada (sin espacios, con bordes).
+
+    Solo alimenta la columna n_trigramas, que se conserva por compatibilidad
+    con espejos existentes; la búsqueda la hace MotorSimilitud.
+    """
+    compacto = f"#{texto_norm.replace(' ', '')}#"
+    return {compacto[i:i + 3] for i in range(len(compacto) - 2)}
+
+
+def _db_marcas():
+    return obtener_conexion_db("marcas.db", _ESQUEMA_MARCAS)
+
+
+def guardar_marcas_locales(registros):
+    """Agrega/actualiza registros IMPI en el espejo local; devuelve cuántos se guardaron"""
+    ahora = time.time()
+    guardados = 0
+    db = _db_marcas()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        for registro in registros:
+            denominacion = (registro.get('denominacion') or '').strip()
+            norm = normalizar_denominacion(denominacion)
+            if not norm:
+                continue
+            clase = registro.get('clase')
+            clase = int(clase) if str(clase or '').isdigit() else None
+            clave = registro.get('expediente') or f"{norm}|{clase or ''}"
+            db.execute(
+                "INSERT INTO marcas (clave, denominacion, denominacion_norm, clave_fonetica, n_trigramas, "
+                "expediente, registro, clase, titular, estatus, actualizado) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(clave) DO UPDATE SET denominacion = excluded.denominacion, "
+                "denominacion_norm = excluded.denominacion_norm, clave_fonetica = excluded.clave_fonetica, "
+                "n_trigramas = excluded.n_trigramas, registro = COALESCE(excluded.registro, registro), "
+                "clase = COALESCE(excluded.clase, clase), titular = COALESCE(excluded.titular, titular), "
+                "estatus = COALESCE(excluded.estatus, estatus), actualizado = excluded.actualizado",
+                (clave, denominacion, norm, clave_fonetica(norm), len(trigramas(norm)), registro.get('expediente'),
+                 registro.get('registro'), clase, registro.get('titular'), registro.get('estatus'), ahora),
+            )
+            guardados += 1
+    return guardados
+
+
+def _leer_archivo_marcas(ruta):
+    """Itera registros de un CSV (con encabezados) o JSONL"""
+    with open(ruta, encoding='utf-8-sig', newline='') as f:
+        if ruta.lower().endswith(('.jsonl', '.ndjson')):
+            for linea in f:
+                if linea.strip():
+                    yield json.loads(linea)
+        else:
+            for fila in csv.DictReader(f):
+                yield {_COLUMNAS_IMPI.get(k.strip().lower(), k.strip().lower()): (v or '').strip() or None
+                       for k, v in fila.items() if k}
+
+
+@app.cli.command("importar-marcas")
+@click.argument("ruta")
+def importar_marcas(ruta):
+    """Importa un archivo CSV/JSONL de marcas IMPI al espejo local"""
+    inicio = time.time()
+    total = 0
+    lote = []
+    for registro in _leer_archivo_marcas(ruta):
+        lote.append(registro)
+        if len(lote) >= 5000:
+            total += guardar_marcas_locales(lote)
+            lote = []
+            click.echo(f"[ESPEJO] {total} marcas importadas...")
+    if lote:
+        total += guardar_marcas_locales(lote)
+    click.echo(f"[ESPEJO] ✓ {total} marcas importadas en {time.time() - inicio:.1f}s")
+
+
+# ============================================
+# MOTOR DE SIMILITUD FONÉTICA Y ORTOGRÁFICA (vectorizado con NumPy)
+# ============================================
+
+SIMILITUD_MAX_LARGO = 24
+
+
+def _codificar_textos(textos, largo):
+    """Lista de str -> matriz uint8 (N, largo) con relleno de ceros, y vector de largos"""
+    crudos = [t.encode('latin-1', 'replace')[:largo] for t in textos]
+    matriz = np.array(crudos, dtype=f'S{largo}').view(np.uint8).reshape(len(crudos), largo)
+    largos = np.fromiter((len(c) for c in crudos), dtype=np.int16, count=len(crudos))
+    return matriz, largos
+
+
+def distancias_edicion(candidato, matriz, largos):
+    """Levenshtein de `candidato` contra cada fila de `matriz`, en lote.
+
+    Recorre los caracteres del candidato; cada paso actualiza la fila de la
+    matriz de programación dinámica de todo el corpus a la vez, de modo que
+    el costo en Python es O(largo_candidato × largo_máximo) operaciones
+    vectoriales, independiente del tamaño del corpus.
+    """
+    n = len(matriz)
+    # Solo hacen falta las columnas hasta el largo máximo presente; se trabaja
+    # con la matriz transpuesta (posición, marca) para que cada operación
+    # recorra el corpus completo de forma contigua
+    largo = int(largos.max()) if n else 0
+    columnas = np.ascontiguousarray(matriz[:, :largo].T)
+    fila = np.repeat(np.arange(largo + 1, dtype=np.int8)[:, None], n, axis=1)
+    t = np.empty_like(fila)
+    costo = np.empty((largo, n), dtype=bool)
+    for i, caracter in enumerate(candidato.encode('latin-1', 'replace')[:SIMILITUD_MAX_LARGO], start=1):
+        np.not_equal(columnas, caracter, out=costo)
+        # T = min(sustitución, borrado) para todas las posiciones a la vez
+        t[0] = i
+        np.add(fila[:-1], costo.view(np.int8), out=t[1:])
+        np.minimum(t[1:], fila[1:] + 1, out=t[1:])
+        # Inserción: dependencia horizontal, posición por posición
+        for j in range(1, largo + 1):
+            np.add(t[j - 1], 1, out=fila[j])
+            np.minimum(fila[j], t[j], out=t[j])
+        fila[:] = t
+    return fila[largos, np.arange(n)]
+
+
+def _similitud_normalizada(candidato, matriz, largos):
+    distancia = distancias_edicion(candidato, matriz, largos)
+    maximo = np.maximum(largos, min(len(candidato), SIMILITUD_MAX_LARGO)).astype(np.float32)
+    return 1.0 - distancia / np.maximum(maximo, 1.0)
+
+
+def _cota_similitud(largo_candidato, largos):
+    """Cota superior de la similitud normalizada: la distancia es al menos |Δ largo|"""
+    largo_candidato = min(largo_candidato, SIMILITUD_MAX_LARGO)
+    maximo = np.maximum(largos, largo_candidato).astype(np.float32)
+    return 1.0 - np.abs(largos - largo_candidato) / np.maximum(maximo, 1.0)
+
+
+def _prefijo_comun(candidato, matriz, limite=4):
+    """Largo del prefijo común (hasta `limite`), como en Jaro-Winkler"""
+    cabeza = np.frombuffer(candidato.encode('latin-1', 'replace')[:limite], dtype=np.uint8)
+    if not len(cabeza):
+        return np.zeros(len(matriz), dtype=np.int16)
+    iguales = matriz[:, :len(cabeza)] == cabeza
+    return np.cumprod(iguales, axis=1, dtype=np.int16).sum(axis=1)
+
+
+class MotorSimilitud:
+    """Puntúa una marca contra todo el corpus en una sola llamada y devuelve el top-k.
+
+    Combina similitud de edición ortográfica (denominación normalizada) y
+    fonética (clave_fonetica), más el bono de prefijo común de Winkler.
+    """
+
+    def __init__(self, peso_fonetico=0.5):
+        self.peso_fonetico = peso_fonetico
+        self.metadatos = []
+        self.normalizadas = []
+        self._orto = self._fono = None
+        self._largos_orto = self._largos_fono = None
+        self._exactas = frozenset()
+        self._lock = threading.Lock()
+        self.version = None
+
+    def __len__(self):
+        return len(self.metadatos)
+
+    def cargar(self, filas, version=None):
+        """filas: (denominacion, denominacion_norm, clave_fonetica, clase, estatus, expediente)"""
+        metadatos = [(f[0], f[3], f[4], f[5]) for f in filas]
+        normalizadas = [f[1] for f in filas]
+        orto, largos_orto = _codificar_textos([n.replace(' ', '') for n in normalizadas], SIMILITUD_MAX_LARGO)
+        fono, largos_fono = _codificar_textos([f[2] for f in filas], SIMILITUD_MAX_LARGO)
+        exactas = frozenset(normalizadas)
+        with self._lock:
+            self.metadatos, self.normalizadas, self._exactas = metadatos, normalizadas, exactas
+            self._orto, self._largos_orto = orto, largos_orto
+            self._fono, self._largos_fono = fono, largos_fono
+            self.version = version
+
+    def contiene(self, marca):
+        """True si la denominación normalizada ya está en el corpus (O(1), sin puntuar)"""
+        return normalizar_denominacion(marca) in self._exactas
+
+    def puntuar(self, marca, umbral=0.0):
+        """Vector de puntuaciones (0-1) de `marca` contra todo el corpus.
+
+        Las filas cuya cota superior (por diferencia de largos) no alcanza
+        `umbral` no se calculan y quedan en 0.
+        """
+        with self._lock:
+            orto, largos_orto, fono, largos_fono = self._orto, self._largos_orto, self._fono, self._largos_fono
+        if orto is None or not len(orto):
+            return np.zeros(0, dtype=np.float32)
+        norm = normalizar_denominacion(marca).replace(' ', '')
+        fonetica = clave_fonetica(norm)
+        prefijo = _prefijo_comun(norm, orto)
+
+        cota = ((1 - self.peso_fonetico) * _cota_similitud(len(norm), largos_orto)
+                + self.peso_fonetico * _cota_similitud(len(fonetica), largos_fono))
+        cota += 0.1 * prefijo * (1 - cota)
+        filas = np.flatnonzero(cota >= umbral)
+
+        puntuacion = np.zeros(len(orto), dtype=np.float32)
+        if len(filas):
+            s_orto = _similitud_normalizada(norm, orto[filas], largos_orto[filas])
+            s_fono = _similitud_normalizada(fonetica, fono[filas], largos_fono[filas])
+            combinada = (1 - self.peso_fonetico) * s_orto + self.peso_fonetico * s_fono
+            puntuacion[filas] = combinada + 0.1 * prefijo[filas] * (1 - combinada)
+        return puntuacion
+
+    def top_k(self, marca, k=10, umbral=0.6):
+        """Las k marcas más parecidas con puntuación >= umbral, de mayor a menor"""
+        puntuacion = self.puntuar(marca, umbral)
+        if not len(puntuacion):
+            return []
+        k = min(k, len(puntuacion))
+        indices = np.argpartition(-puntuacion, k - 1)[:k]
+        indices = indices[np.argsort(-puntuacion[indices])]
+        norm = normalizar_denominacion(marca)
+        resultado = []
+        for indice in indices:
+            if puntuacion[indice] < umbral:
+                break
+            denominacion, clase, estatus, expediente = self.metadatos[indice]
+            resultado.append({
+                "denominacion": denominacion,
+                "clase": clase,
+                "estatus": estatus,
+                "expediente": expediente,
+                "similitud": round(float(puntuacion[indice]), 3),
+                "exacta": self.normalizadas[indice] == norm,
+            })
+        return resultado
+
+
+# Cada recarga arma un motor nuevo y reemplaza la referencia entera: las consultas
+# en curso terminan con el corpus que tomaron y nunca ven uno a medio cargar
+motor_similitud = MotorSimilitud()
+_recarga_similitud_lock = threading.Lock()
+_recarga_similitud_pid = None
+
+
+def _en_hilo_nativo(funcion, *args):
+    """Bajo gevent corre `funcion` en el pool de hilos reales del hub.
+
+    El cálculo con NumPy y la lectura del corpus no ceden al hub; en un
+    greenlet congelarían todas las peticiones del worker mientras duran.
+    """
+    if MODO_GEVENT:
+        import gevent
+        return gevent.get_hub().threadpool.apply(funcion, args)
+    return funcion(*args)
+
+
+def _construir_motor_similitud(version_actual):
+    """Motor nuevo con el corpus del espejo local; None si la versión no cambió"""
+    db = _db_marcas()
+    version = db.execute("SELECT COUNT(*), MAX(actualizado) FROM marcas").fetchone()
+    if version == version_actual:
+        return None
+    filas = db.execute(
+        "SELECT denominacion, denominacion_norm, clave_fonetica, clase, estatus, expediente FROM marcas"
+    ).fetchall()
+    motor = MotorSimilitud()
+    motor.cargar(filas, version)
+    return motor
+
+
+def cargar_motor_similitud(nativo=True):
+    """Reconstruye el motor si el espejo cambió y lo publica con una sola asignación"""
+    global motor_similitud
+    inicio = time.time()
+    if nativo:
+        nuevo = _en_hilo_nativo(_construir_motor_similitud, motor_similitud.version)
+    else:
+        nuevo = _construir_motor_similitud(motor_similitud.version)
+    if nuevo is not None:
+        motor_similitud = nuevo
+        log_espejo.info(f"✓ Corpus de {len(nuevo)} marcas cargado en {time.time() - inicio:.2f}s")
+
+
+def _bucle_recarga_similitud():
+    while True:
+        try:
+            cargar_motor_similitud()
+        except Exception as e:
+            log_espejo.error(f"✗ Recarga del corpus: {e}")
+        time.sleep(SIMILITUD_RECARGA)
+
+
+def _asegurar_recarga_similitud():
+    """Arranca el hilo de recarga del corpus en este proceso (una vez por worker)"""
+    global _recarga_similitud_pid
+    if _recarga_similitud_pid == os.getpid():
+        return
+    with _recarga_similitud_lock:
+        if _recarga_similitud_pid == os.getpid():
+            return
+        _recarga_similitud_pid = os.getpid()
+    threading.Thread(target=_bucle_recarga_similitud, name="similitud", daemon=True).start()
+
+
+def coincidencia_exacta_local(marca):
+    """True si el espejo local ya tiene exactamente esta denominación"""
+    return motor_similitud.contiene(marca)
+
+
+def marcas_similares(marca, k=10):
+    """Top-k de marcas parecidas del espejo local con el motor vigente (la recarga va aparte)"""
+    _asegurar_recarga_similitud()
+    motor = motor_similitud
+    if not len(motor):
+        return []
+    try:
+        return _en_hilo_nativo(motor.top_k, marca, k)
+    except Exception as e:
+        log_espejo.error(f"✗ Error: {e}")
+        return []
+
 
 def guardar_en_sheets(datos, hoja="leads"):
     """Guarda datos en Google Sheets"""
     if not GOOGLE_APPS_SCRIPT_URL:
-        print("⚠ Google Apps Script no configurado")
+        log_sheets.warning("⚠ Google Apps Script no configurado")
         return False
     
     try:
         payload = {'hoja': hoja, 'datos': datos}
-        response = requests.post(GOOGLE_APPS_SCRIPT_URL, json=payload, timeout=15)
+        with metricas.medir('sheets') as medicion:
+            response = http_compartido().post(GOOGLE_APPS_SCRIPT_URL, json=payload, timeout=(5, 15))
+            medicion.ok = response.status_code == 200
         
         if response.status_code == 200:
-            print(f"[SHEETS] ✓ Guardado en '{hoja}'")
+            log_sheets.info(f"✓ Guardado en '{hoja}'")
             return True
-        print(f"[SHEETS] ✗ Error {response.status_code}")
+        log_sheets.error(f"✗ Error {response.status_code}")
         return False
     except Exception as e:
-        print(f"[SHEETS] ✗ Error: {e}")
+        log_sheets.error(f"✗ Error: {e}")
         return False
 
 
-def enviar_email_lead(datos_lead):
-    """Envía email de notificación (versión ligera)"""
-    if not GMAIL_USER or not GMAIL_PASSWORD:
-        print("[EMAIL] ⚠ No configurado")
-        return False
+def guardar_lote_en_sheets(filas, hoja="leads"):
+    """Guarda varias filas en una sola llamada a Apps Script.
+
+    Envía {'hoja', 'lote': True, 'datos': [fila, ...]} y espera
+    {'resultados': [{'ok': bool}, ...]} en el mismo orden. Apps Script
+    responde 200 aunque el script falle, así que sin acuses por fila
+    ninguna se da por guardada (el outbox las reintenta).
+    """
+    if not GOOGLE_APPS_SCRIPT_URL:
+        log_sheets.warning("⚠ Google Apps Script no configurado")
+        return [False] * len(filas)
     
     try:
-        # Usar texto plano en lugar de HTML para reducir memoria
-        texto = f"""
+        payload = {'hoja': hoja, 'lote': True, 'datos': filas}
+        with metricas.medir('sheets_lote') as medicion:
+            response = http_compartido().post(GOOGLE_APPS_SCRIPT_URL, json=payload)
+            medicion.ok = response.status_code == 200
+        
+        if response.status_code != 200:
+            log_sheets.error(f"✗ Error {response.status_code} en lote de {len(filas)}")
+            return [False] * len(filas)
+        
+        try:
+            resultados = response.json().get('resultados')
+        except (ValueError, AttributeError):
+            resultados = None
+        if not isinstance(resultados, list) or len(resultados) != len(filas):
+            log_sheets.error(f"✗ Respuesta sin acuses por fila en lote de {len(filas)}")
+            return [False] * len(filas)
+        acuses = [bool(r.get('ok')) if isinstance(r, dict) else bool(r) for r in resultados]
+        log_sheets.info(f"✓ Lote en '{hoja}': {sum(acuses)}/{len(filas)} filas")
+        metricas.contar('sheets_lotes', hoja=hoja)
+        metricas.contar('sheets_filas', sum(acuses), hoja=hoja)
+        return acuses
+    except Exception as e:
+        log_sheets.error(f"✗ Error en lote: {e}")
+        return [False] * len(filas)
+
+
+class EscritorSheetsLotes:
+    """Agrupa filas por hoja durante una ventana corta (o hasta N filas) y las envía juntas"""
+
+    def __init__(self, ventana, maximo):
+        self.ventana = ventana
+        self.maximo = maximo
+        self._cond = threading.Condition()
+        self._pendientes = {}
+        self._stats = {}
+        self._pid = None
+
+    def agregar(self, datos, hoja="leads"):
+        """Encola una fila; devuelve un Future que resuelve a True/False (acuse de la fila)"""
+        futuro = Future()
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pendientes = {}
+                threading.Thread(target=self._bucle, name="sheets-lotes", daemon=True).start()
+            self._pendientes.setdefault(hoja, []).append((datos, futuro, time.time()))
+            self._cond.notify()
+        return futuro
+
+    def _tomar_listos(self):
+        """Espera a que alguna hoja cumpla la ventana o el tamaño máximo y la extrae"""
+        with self._cond:
+            while True:
+                while not self._pendientes:
+                    self._cond.wait()
+                ahora = time.time()
+                listos = {}
+                espera = self.ventana
+                for hoja, filas in list(self._pendientes.items()):
+                    restante = filas[0][2] + self.ventana - ahora
+                    if len(filas) >= self.maximo or restante <= 0:
+                        listos[hoja] = filas[:self.maximo]
+                        resto = filas[self.maximo:]
+                        if resto:
+                            self._pendientes[hoja] = resto
+                        else:
+                            del self._pendientes[hoja]
+                    else:
+                        espera = min(espera, restante)
+                if listos:
+                    return listos
+                self._cond.wait(espera)
+
+    def _bucle(self):
+        while True:
+            for hoja, filas in self._tomar_listos().items():
+                inicio = time.time()
+                try:
+                    acuses = guardar_lote_en_sheets([f[0] for f in filas], hoja=hoja)
+                except Exception as e:
+                    log_sheets.error(f"✗ Error en lote: {e}")
+                    acuses = [False] * len(filas)
+                fin = time.time()
+                for (_, futuro, _), ok in zip(filas, acuses):
+                    futuro.set_result(ok)
+                self._registrar(hoja, len(filas), fin - inicio, fin - filas[0][2])
+
+    def _registrar(self, hoja, tamano, duracion, espera):
+        with self._cond:
+            s = self._stats.setdefault(hoja, {
+                "lotes": 0, "filas": 0, "max_filas": 0,
+                "envio_total": 0.0, "envio_max": 0.0, "espera_total": 0.0,
+            })
+            s["lotes"] += 1
+            s["filas"] += tamano
+            s["max_filas"] = max(s["max_filas"], tamano)
+            s["envio_total"] += duracion
+            s["envio_max"] = max(s["envio_max"], duracion)
+            s["espera_total"] += espera
+
+    def estadisticas(self):
+        """Tamaño de lote y latencia de envío por hoja (en este worker)"""
+        with self._cond:
+            return {
+                hoja: {
+                    "lotes": s["lotes"],
+                    "filas": s["filas"],
+                    "filas_por_lote": round(s["filas"] / s["lotes"], 2),
+                    "max_filas": s["max_filas"],
+                    "envio_promedio_ms": round(1000 * s["envio_total"] / s["lotes"], 1),
+                    "envio_max_ms": round(1000 * s["envio_max"], 1),
+                    "espera_promedio_ms": round(1000 * s["espera_total"] / s["lotes"], 1),
+                }
+                for hoja, s in self._stats.items()
+            }
+
+
+escritor_sheets = EscritorSheetsLotes(SHEETS_LOTE_VENTANA, SHEETS_LOTE_MAX)
+
+
+def _texto_lead(datos_lead):
+    return f"""
 NUEVO LEAD - CONSULTOR DE MARCAS
 
 Nombre: {datos_lead.get('nombre', 'N/A')}
@@ -516,38 +2572,1040 @@ Marca: {datos_lead.get('marca', 'N/A')}
 Status: {datos_lead.get('status_impi', 'N/A')}
 Clase: {datos_lead.get('clase_sugerida', 'N/A')}
 
-Fecha: {datetime.now(MEXICO_TZ).strftime('%Y-%m-%d %H:%M')}
+Fecha: {datos_lead.get('fecha') or datetime.now(MEXICO_TZ).strftime('%Y-%m-%d')} {datos_lead.get('hora', '')}
         """
-        
-        mensaje = MIMEText(texto, 'plain', 'utf-8')
-        mensaje['Subject'] = f"Lead - {datos_lead.get('nombre', 'Cliente')} | {datos_lead.get('marca', 'Marca')}"
-        mensaje['From'] = GMAIL_USER
-        mensaje['To'] = EMAIL_DESTINO
-        
-        with smtplib.SMTP('smtp.gmail.com', 587, timeout=10) as servidor:
-            servidor.starttls()
-            servidor.login(GMAIL_USER, GMAIL_PASSWORD)
-            servidor.send_message(mensaje)
-        
-        print(f"[EMAIL] ✓ Enviado")
-        return True
+
+
+def _mensaje_email(asunto, texto):
+    # Usar texto plano en lugar de HTML para reducir memoria
+    mensaje = MIMEText(texto, 'plain', 'utf-8')
+    mensaje['Subject'] = asunto
+    mensaje['From'] = GMAIL_USER
+    mensaje['To'] = EMAIL_DESTINO
+    return mensaje
+
+
+def mensaje_email_lead(datos_lead):
+    asunto = f"Lead - {datos_lead.get('nombre', 'Cliente')} | {datos_lead.get('marca', 'Marca')}"
+    return _mensaje_email(asunto, _texto_lead(datos_lead))
+
+
+class EnviadorEmail:
+    """Una conexión SMTP persistente por worker alimentada por una cola.
+
+    Reconecta (STARTTLS + login) solo cuando el servidor cerró la sesión o tras
+    SMTP_INACTIVIDAD segundos sin uso. Con EMAIL_RESUMEN_MINUTOS > 0 además junta
+    los leads en la tabla email_resumen y manda un solo correo por ventana.
+    """
+
+    def __init__(self, inactividad, resumen_minutos):
+        self.inactividad = inactividad
+        self.resumen_minutos = resumen_minutos
+        self._cond = threading.Condition()
+        self._pendientes = []
+        self._smtp = None
+        self._ultimo_uso = 0.0
+        self._pid = None
+
+    def asegurar(self):
+        """Arranca el hilo de envío en este proceso (una vez por worker)"""
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pendientes = []
+                self._smtp = None
+                threading.Thread(target=self._bucle, name="email", daemon=True).start()
+
+    def agregar(self, mensaje):
+        """Encola un mensaje; devuelve un Future que resuelve a True/False"""
+        futuro = Future()
+        self.asegurar()
+        with self._cond:
+            self._pendientes.append((mensaje, futuro))
+            self._cond.notify()
+        return futuro
+
+    def _bucle(self):
+        while True:
+            with self._cond:
+                if not self._pendientes:
+                    self._cond.wait(30 if self.resumen_minutos else self.inactividad)
+                lote, self._pendientes = self._pendientes, []
+            for mensaje, futuro in lote:
+                futuro.set_result(self._enviar(mensaje))
+            if self.resumen_minutos:
+                try:
+                    self._enviar_resumen_si_toca()
+                except sqlite3.Error as e:
+                    log_email.error(f"✗ Error en resumen: {e}")
+            if self._smtp is not None and time.monotonic() - self._ultimo_uso > self.inactividad:
+                self._cerrar()
+
+    def _conectar(self):
+        with metricas.medir('email_conexion'):
+            smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10)
+            try:
+                if SMTP_STARTTLS:
+                    smtp.starttls()
+                smtp.login(GMAIL_USER, GMAIL_PASSWORD)
+            except Exception:
+                smtp.close()
+                raise
+        metricas.contar('email_conexiones')
+        return smtp
+
+    def _cerrar(self):
+        try:
+            self._smtp.quit()
+        except Exception:
+            self._smtp.close()
+        self._smtp = None
+
+    def _enviar(self, mensaje):
+        for intento in range(2):
+            try:
+                if self._smtp is None:
+                    self._smtp = self._conectar()
+                with metricas.medir('email'):
+                    self._smtp.send_message(mensaje)
+                self._ultimo_uso = time.monotonic()
+                log_email.info("✓ Enviado", extra={"asunto": mensaje['Subject']})
+                return True
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, OSError) as e:
+                # Conexión vencida o cortada por el servidor: se abre otra y se reintenta una vez
+                log_email.warning(f"⚠ Reconectando SMTP (intento {intento + 1}): {e}")
+                if self._smtp is not None:
+                    self._smtp.close()
+                    self._smtp = None
+            except Exception as e:
+                log_email.error(f"✗ {e}")
+                return False
+        return False
+
+    def _enviar_resumen_si_toca(self):
+        """Manda en un correo los leads acumulados si el más antiguo ya cumplió la ventana"""
+        ahora = time.time()
+        db = _db_outbox()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            primero = db.execute(
+                "SELECT MIN(creado) FROM email_resumen WHERE enviando_hasta <= ?", (ahora,)
+            ).fetchone()[0]
+            if primero is None or ahora - primero < self.resumen_minutos * 60:
+                return
+            filas = db.execute(
+                "SELECT id, datos, creado, intentos FROM email_resumen WHERE enviando_hasta <= ? ORDER BY id", (ahora,)
+            ).fetchall()
+            db.executemany(
+                "UPDATE email_resumen SET enviando_hasta = ? WHERE id = ?",
+                [(ahora + OUTBOX_LEASE, fila[0]) for fila in filas],
+            )
+
+        leads = [json.loads(fila[1]) for fila in filas]
+        asunto = f"Resumen: {len(leads)} lead{'s' if len(leads) != 1 else ''} nuevo{'s' if len(leads) != 1 else ''}"
+        texto = f"\n{'-' * 40}\n".join(_texto_lead(d) for d in leads)
+        ids = [(fila[0],) for fila in filas]
+        if self._enviar(_mensaje_email(asunto, texto)):
+            db.executemany("DELETE FROM email_resumen WHERE id = ?", ids)
+            metricas.contar('email_resumenes')
+        else:
+            _posponer_resumen_email(filas, "Entrega rechazada")
+
+
+enviador_email = EnviadorEmail(SMTP_INACTIVIDAD, EMAIL_RESUMEN_MINUTOS)
+
+
+def agregar_a_resumen_email(datos_lead):
+    """Guarda el lead para el siguiente correo de resumen; devuelve un Future ya resuelto"""
+    futuro = Future()
+    _db_outbox().execute(
+        "INSERT INTO email_resumen (datos, creado) VALUES (?, ?)",
+        (json.dumps(datos_lead, ensure_ascii=False), time.time()),
+    )
+    enviador_email.asegurar()
+    futuro.set_result(True)
+    return futuro
+
+
+def _posponer_resumen_email(filas, error):
+    """Programa el reintento de un resumen que no salió.
+
+    Usa el mismo backoff que el outbox; tras OUTBOX_MAX_INTENTOS cada lead pasa
+    a outbox_fallidos como una tarea 'email' más.
+    """
+    ahora = time.time()
+    intentos = max(fila[3] for fila in filas) + 1
+    espera = _espera_reintento(intentos)
+    db = _db_outbox()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        for id_fila, datos, creado, _ in filas:
+            if intentos >= OUTBOX_MAX_INTENTOS:
+                # El id sale de la secuencia del outbox para no chocar con tareas en outbox_fallidos
+                id_tarea = db.execute(
+                    "INSERT INTO outbox (tipo, payload, intentos, proximo_intento, creado) "
+                    "VALUES ('email', ?, ?, ?, ?) RETURNING id",
+                    (datos, intentos, ahora, creado),
+                ).fetchone()[0]
+                _mover_a_fallidos_outbox(db, id_tarea, intentos, error, ahora)
+                db.execute("DELETE FROM email_resumen WHERE id = ?", (id_fila,))
+            else:
+                db.execute(
+                    "UPDATE email_resumen SET intentos = ?, enviando_hasta = ?, ultimo_error = ? WHERE id = ?",
+                    (intentos, ahora + espera, error, id_fila),
+                )
+    if intentos >= OUTBOX_MAX_INTENTOS:
+        log_email.error(f"✗ Resumen de {len(filas)} leads enviado a fallidos tras {intentos} intentos")
+        metricas.contar('outbox_entregas', tipo='email_resumen', resultado='fallida')
+    else:
+        log_email.warning(f"⚠ Resumen de {len(filas)} leads: reintento {intentos} en {espera:.0f}s")
+        metricas.contar('outbox_entregas', tipo='email_resumen', resultado='reintento')
+
+
+def reanudar_resumen_email():
+    """Al arrancar el worker: si quedaron leads para el resumen, arranca el hilo que lo envía"""
+    if EMAIL_RESUMEN_MINUTOS <= 0 or not GMAIL_USER or not GMAIL_PASSWORD:
+        return
+    if _db_outbox().execute("SELECT 1 FROM email_resumen LIMIT 1").fetchone():
+        enviador_email.asegurar()
+
+
+def encolar_email_lead(datos_lead):
+    """Entrega del outbox: al resumen o a la conexión SMTP persistente (Future)"""
+    if not GMAIL_USER or not GMAIL_PASSWORD:
+        log_email.warning("⚠ No configurado")
+        futuro = Future()
+        futuro.set_result(False)
+        return futuro
+    if EMAIL_RESUMEN_MINUTOS > 0:
+        return agregar_a_resumen_email(datos_lead)
+    return enviador_email.agregar(mensaje_email_lead(datos_lead))
+
+
+def enviar_email_lead(datos_lead):
+    """Envía email de notificación (versión ligera) y espera el resultado"""
+    try:
+        return encolar_email_lead(datos_lead).result(timeout=60)
     except Exception as e:
-        print(f"[EMAIL] ✗ {e}")
+        log_email.error(f"✗ {e}")
         return False
 
 
+# ============================================
+# PROTECCIÓN IMPI (circuit breaker + concurrencia adaptativa)
+# ============================================
+
+class CircuitoProteccion:
+    """Circuit breaker cerrado/abierto/semiabierto por tasa de fallos en una ventana de tiempo.
+
+    Una llamada cuenta como fallo si termina en error o tarda más de `latencia_max`.
+    """
+
+    def __init__(self, nombre, ventana, minimo, umbral, latencia_max, enfriamiento):
+        self.nombre = nombre
+        self.ventana = ventana
+        self.minimo = minimo
+        self.umbral = umbral
+        self.latencia_max = latencia_max
+        self.enfriamiento = enfriamiento
+        self.estado = "cerrado"
+        self._llamadas = deque()
+        self._abierto_hasta = 0.0
+        self._sondeo_en_curso = False
+        self._lock = threading.Lock()
+
+    def abierto(self):
+        """True si hoy no se dejaría pasar ninguna llamada (no consume el sondeo)"""
+        with self._lock:
+            if self.estado == "abierto":
+                return time.monotonic() < self._abierto_hasta
+            return self.estado == "semiabierto" and self._sondeo_en_curso
+
+    def permitir(self):
+        """Autoriza una llamada; en semiabierto solo pasa un sondeo a la vez"""
+        with self._lock:
+            if self.estado == "abierto":
+                if time.monotonic() < self._abierto_hasta:
+                    return False
+                self.estado = "semiabierto"
+                log_proteccion.info("◐ Circuito semiabierto, probando", extra={"servicio": self.nombre})
+                metricas.contar('circuito_transiciones', servicio=self.nombre, estado=self.estado)
+            if self.estado == "semiabierto":
+                if self._sondeo_en_curso:
+                    return False
+                self._sondeo_en_curso = True
+            return True
+
+    def cancelar(self):
+        """La llamada autorizada no llegó a hacerse"""
+        with self._lock:
+            self._sondeo_en_curso = False
+
+    def registrar(self, exito, duracion):
+        fallo = not exito or duracion > self.latencia_max
+        ahora = time.monotonic()
+        with self._lock:
+            if self.estado == "semiabierto":
+                self._sondeo_en_curso = False
+                if fallo:
+                    self._abrir(ahora)
+                else:
+                    self.estado = "cerrado"
+                    self._llamadas.clear()
+                    log_proteccion.info("✓ Circuito cerrado", extra={"servicio": self.nombre})
+                    metricas.contar('circuito_transiciones', servicio=self.nombre, estado=self.estado)
+                return
+
+            self._llamadas.append((ahora, fallo))
+            while self._llamadas and self._llamadas[0][0] < ahora - self.ventana:
+                self._llamadas.popleft()
+            if self.estado == "cerrado" and len(self._llamadas) >= self.minimo:
+                fallos = sum(1 for _, f in self._llamadas if f)
+                if fallos / len(self._llamadas) >= self.umbral:
+                    self._abrir(ahora)
+
+    def _abrir(self, ahora):
+        self.estado = "abierto"
+        self._abierto_hasta = ahora + self.enfriamiento
+        self._llamadas.clear()
+        log_proteccion.warning(f"⚡ Circuito abierto por {self.enfriamiento:.0f}s", extra={"servicio": self.nombre})
+        metricas.contar('circuito_transiciones', servicio=self.nombre, estado=self.estado)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "estado": self.estado,
+                "llamadas_ventana": len(self._llamadas),
+                "fallos_ventana": sum(1 for _, f in self._llamadas if f),
+            }
+
+
+class LimiteAdaptativo:
+    """Límite de llamadas simultáneas con AIMD: +1 por ventana de éxitos rápidos, ÷2 ante fallo o lentitud"""
+
+    def __init__(self, nombre, minimo, maximo, latencia_objetivo):
+        self.nombre = nombre
+        self.minimo = minimo
+        self.maximo = maximo
+        self.latencia_objetivo = latencia_objetivo
+        self.limite = float(max(minimo, maximo // 2))
+        self.en_uso = 0
+        self._ultimo_recorte = 0.0
+        self._cond = threading.Condition()
+
+    def adquirir(self, espera_max):
+        limite = time.monotonic() + espera_max
+        with self._cond:
+            while self.en_uso >= int(self.limite):
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    log_proteccion.warning(f"⚠ Límite de concurrencia ({int(self.limite)}) alcanzado", extra={"servicio": self.nombre})
+                    return False
+                self._cond.wait(restante)
+            self.en_uso += 1
+            return True
+
+    def liberar(self, exito=None, duracion=0.0):
+        """Devuelve el lugar; con exito=None no ajusta el límite"""
+        with self._cond:
+            self.en_uso -= 1
+            if exito is not None:
+                ahora = time.monotonic()
+                if exito and duracion <= self.latencia_objetivo:
+                    self.limite = min(self.maximo, self.limite + 1 / self.limite)
+                elif ahora - self._ultimo_recorte > self.latencia_objetivo:
+                    # Un solo recorte por episodio: las llamadas que ya estaban en vuelo no lo repiten
+                    self._ultimo_recorte = ahora
+                    self.limite = max(self.minimo, self.limite / 2)
+                    log_proteccion.warning(f"↓ Concurrencia reducida a {int(self.limite)}", extra={"servicio": self.nombre})
+            self._cond.notify()
+
+    def estadisticas(self):
+        with self._cond:
+            return {"limite": int(self.limite), "en_uso": self.en_uso}
+
+
+circuito_impi = CircuitoProteccion(
+    "IMPI", IMPI_CIRCUITO_VENTANA, IMPI_CIRCUITO_MIN_LLAMADAS, IMPI_CIRCUITO_UMBRAL,
+    IMPI_CIRCUITO_LATENCIA, IMPI_CIRCUITO_ENFRIAMIENTO,
+)
+concurrencia_impi = LimiteAdaptativo("IMPI", 1, IMPI_CONCURRENCIA_MAX, IMPI_LATENCIA_OBJETIVO)
+
+
+# ============================================
+# EJECUCIÓN CONCURRENTE
+# ============================================
+
+_executor_analisis = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# Instante (time.monotonic) en que vence el análisis en curso; las tareas enviadas lo heredan
+limite_analisis = contextvars.ContextVar("limite_analisis", default=None)
+# True en el análisis de un elemento de /analizar/lote (solo ahí aplica limite_impi)
+en_lote = contextvars.ContextVar("en_lote", default=False)
+
+
+class EjecutorConContexto(ThreadPoolExecutor):
+    """ThreadPoolExecutor que ejecuta cada tarea con el contexto de quien la envía (request-id de los logs)"""
+
+    def submit(self, funcion, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, funcion, *args, **kwargs)
+
+
+def obtener_executor():
+    """Pool de hilos del proceso para llamadas externas (se recrea tras un fork)"""
+    global _executor_analisis, _executor_pid
+    with _executor_lock:
+        if _executor_analisis is None or _executor_pid != os.getpid():
+            _executor_analisis = EjecutorConContexto(max_workers=ANALISIS_MAX_HILOS, thread_name_prefix="analisis")
+            _executor_pid = os.getpid()
+        return _executor_analisis
+
+
+class LimitadorTasa:
+    """Token bucket por host: `tasa` llamadas/s con ráfagas de hasta `rafaga`"""
+
+    def __init__(self, nombre, tasa, rafaga):
+        self.nombre = nombre
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self._fichas = float(rafaga)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self, espera_max=10.0):
+        """Espera una ficha; False si no hubo una disponible en `espera_max` segundos"""
+        limite = time.monotonic() + espera_max
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.rafaga, self._fichas + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return True
+                faltante = (1 - self._fichas) / self.tasa
+            if ahora + faltante > limite:
+                log_proteccion.warning("⚠ Límite de tasa alcanzado", extra={"servicio": self.nombre})
+                return False
+            time.sleep(faltante)
+
+
+limite_impi = LimitadorTasa("IMPI", IMPI_TASA, max(1, int(IMPI_TASA * 2)))
+limite_gemini = LimitadorTasa("GEMINI", GEMINI_TASA, max(1, int(GEMINI_TASA * 2)))
+
+
+def _resultado_o_respaldo(futuro, respaldo, etiqueta):
+    """Resultado del futuro si terminó bien; si no, el valor de respaldo"""
+    if not futuro.done():
+        log_analisis.warning(f"⏱ Deadline de {ANALISIS_DEADLINE}s alcanzado, usando respaldo", extra={"etapa": etiqueta})
+        metricas.contar('respaldos', etapa=etiqueta, motivo='deadline')
+        return respaldo()
+    try:
+        return futuro.result()
+    except Exception as e:
+        log_analisis.error(f"✗ Error: {e}", extra={"etapa": etiqueta})
+        metricas.contar('respaldos', etapa=etiqueta, motivo='error')
+        return respaldo()
+
+
+# ============================================
+# OUTBOX DURABLE (efectos secundarios en segundo plano)
+# ============================================
+
+_ESQUEMA_OUTBOX = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tipo TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    proximo_intento REAL NOT NULL,
+    bloqueado_hasta REAL NOT NULL DEFAULT 0,
+    creado REAL NOT NULL,
+    ultimo_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_proximo ON outbox(proximo_intento);
+CREATE TABLE IF NOT EXISTS outbox_fallidos (
+    id INTEGER PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    intentos INTEGER NOT NULL,
+    creado REAL NOT NULL,
+    fallido REAL NOT NULL,
+    ultimo_error TEXT
+);
+CREATE TABLE IF NOT EXISTS email_resumen (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    datos TEXT NOT NULL,
+    creado REAL NOT NULL,
+    enviando_hasta REAL NOT NULL DEFAULT 0,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    ultimo_error TEXT
+);
+"""
+
+# tipo -> función que recibe el payload y devuelve True si se entregó
+_MANEJADORES_OUTBOX = {
+    'sheets': lambda p: guardar_en_sheets(p['datos'], hoja=p['hoja']),
+    'push': enviar_notificacion_push,
+    'push_pago': enviar_notificacion_push_pago,
+    'email': enviar_email_lead,
+}
+
+# tipo -> función que recibe el payload y devuelve un Future (entrega agrupada)
+_MANEJADORES_OUTBOX_LOTE = {
+    'email': encolar_email_lead,
+}
+if SHEETS_LOTES:
+    _MANEJADORES_OUTBOX_LOTE['sheets'] = lambda p: escritor_sheets.agregar(p['datos'], hoja=p['hoja'])
+
+_outbox_evento = threading.Event()
+_outbox_lock = threading.Lock()
+_outbox_pid = None
+
+
+def _db_outbox():
+    return obtener_conexion_db("outbox.db", _ESQUEMA_OUTBOX, DATOS_DURABLES_DIR)
+
+
+def _asegurar_despachador_outbox():
+    """Arranca el hilo despachador en este proceso (una vez por worker)"""
+    global _outbox_pid
+    if _outbox_pid == os.getpid():
+        return
+    with _outbox_lock:
+        if _outbox_pid == os.getpid():
+            return
+        _outbox_pid = os.getpid()
+    threading.Thread(target=_bucle_outbox, name="outbox", daemon=True).start()
+
+
+def encolar_tareas(tareas):
+    """Guarda [(tipo, payload), ...] en la cola local en una sola transacción"""
+    ahora = time.time()
+    try:
+        db = _db_outbox()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT INTO outbox (tipo, payload, proximo_intento, creado) VALUES (?, ?, ?, ?)",
+                [(tipo, json.dumps(payload, ensure_ascii=False), ahora, ahora) for tipo, payload in tareas],
+            )
+    except sqlite3.Error as e:
+        # Si la cola local falla, entregar directamente para no perder el lead
+        log_outbox.error(f"✗ No se pudo encolar ({e}), entregando en línea")
+        for tipo, payload in tareas:
+            _MANEJADORES_OUTBOX[tipo](payload)
+        return False
+
+    _asegurar_despachador_outbox()
+    _outbox_evento.set()
+    return True
+
+
+def _reclamar_tareas_outbox(limite):
+    """Toma tareas vencidas y las bloquea para este worker durante OUTBOX_LEASE"""
+    ahora = time.time()
+    db = _db_outbox()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        filas = db.execute(
+            "SELECT id, tipo, payload, intentos FROM outbox "
+            "WHERE proximo_intento <= ? AND bloqueado_hasta <= ? ORDER BY id LIMIT ?",
+            (ahora, ahora, limite),
+        ).fetchall()
+        db.executemany(
+            "UPDATE outbox SET bloqueado_hasta = ? WHERE id = ?",
+            [(ahora + OUTBOX_LEASE, fila[0]) for fila in filas],
+        )
+    return filas
+
+
+def _renovar_lease_outbox(ids):
+    """Extiende el bloqueo de tareas todavía en curso; devuelve el nuevo vencimiento"""
+    vence = time.time() + OUTBOX_LEASE
+    if ids:
+        db = _db_outbox()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("UPDATE outbox SET bloqueado_hasta = ? WHERE id = ?", [(vence, i) for i in ids])
+    return vence
+
+
+def _espera_reintento(intentos):
+    """Backoff exponencial con jitter antes del reintento número `intentos`"""
+    espera = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (intentos - 1)))
+    return espera * random.uniform(0.5, 1.0)
+
+
+def _mover_a_fallidos_outbox(db, id_tarea, intentos, error, ahora):
+    """Pasa la tarea a outbox_fallidos (dentro de la transacción abierta en `db`)"""
+    db.execute(
+        "INSERT OR REPLACE INTO outbox_fallidos (id, tipo, payload, intentos, creado, fallido, ultimo_error) "
+        "SELECT id, tipo, payload, ?, creado, ?, ? FROM outbox WHERE id = ?",
+        (intentos, ahora, error, id_tarea),
+    )
+    db.execute("DELETE FROM outbox WHERE id = ?", (id_tarea,))
+
+
+def _registrar_resultado_outbox(id_tarea, tipo, intentos, error):
+    """Borra la tarea entregada o programa el reintento / la manda a fallidos"""
+    db = _db_outbox()
+    if error is None:
+        db.execute("DELETE FROM outbox WHERE id = ?", (id_tarea,))
+        metricas.contar('outbox_entregas', tipo=tipo, resultado='ok')
+        return
+
+    intentos += 1
+    ahora = time.time()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        if intentos >= OUTBOX_MAX_INTENTOS:
+            _mover_a_fallidos_outbox(db, id_tarea, intentos, error, ahora)
+            log_outbox.error(f"✗ Tarea {id_tarea} ({tipo}) enviada a fallidos tras {intentos} intentos")
+            metricas.contar('outbox_entregas', tipo=tipo, resultado='fallida')
+            return
+        espera = _espera_reintento(intentos)
+        db.execute(
+            "UPDATE outbox SET intentos = ?, proximo_intento = ?, bloqueado_hasta = 0, ultimo_error = ? WHERE id = ?",
+            (intentos, ahora + espera, error, id_tarea),
+        )
+    log_outbox.warning(f"⚠ Tarea {id_tarea} ({tipo}) reintento {intentos} en {espera:.0f}s")
+    metricas.contar('outbox_entregas', tipo=tipo, resultado='reintento')
+
+
+def _ejecutar_tarea_outbox(tipo, payload):
+    """Devuelve None si se entregó o el texto del error"""
+    manejador = _MANEJADORES_OUTBOX.get(tipo)
+    if manejador is None:
+        return f"Tipo desconocido: {tipo}"
+    try:
+        return None if manejador(json.loads(payload)) else "Entrega rechazada"
+    except Exception as e:
+        return str(e)[:500]
+
+
+def _bucle_outbox():
+    try:
+        reanudar_resumen_email()
+    except Exception as e:
+        log_email.error(f"✗ Error revisando el resumen pendiente: {e}")
+    while True:
+        try:
+            tareas = _reclamar_tareas_outbox(OUTBOX_LOTE)
+            agrupadas = []
+            # Las tareas sueltas van en serie: cada una renueva el lease de lo que sigue en
+            # espera para que otro worker no las reclame mientras la anterior tarda
+            for posicion, (id_tarea, tipo, payload, intentos) in enumerate(tareas):
+                if tipo in _MANEJADORES_OUTBOX_LOTE:
+                    futuro = _MANEJADORES_OUTBOX_LOTE[tipo](json.loads(payload))
+                    agrupadas.append((id_tarea, tipo, intentos, futuro))
+                    continue
+                _renovar_lease_outbox([t[0] for t in tareas[posicion:]] + [a[0] for a in agrupadas])
+                error = _ejecutar_tarea_outbox(tipo, payload)
+                _registrar_resultado_outbox(id_tarea, tipo, intentos, error)
+            # Los acuses de los lotes se esperan dentro de un solo lease recién renovado
+            vence = _renovar_lease_outbox([a[0] for a in agrupadas])
+            for id_tarea, tipo, intentos, futuro in agrupadas:
+                try:
+                    restante = max(0.0, vence - time.time())
+                    error = None if futuro.result(timeout=restante) else "Entrega rechazada"
+                except Exception as e:
+                    error = str(e)[:500] or "Sin acuse"
+                _registrar_resultado_outbox(id_tarea, tipo, intentos, error)
+            if tareas:
+                continue
+        except Exception as e:
+            log_outbox.error(f"✗ Error en despachador: {e}")
+        _outbox_evento.wait(OUTBOX_INTERVALO)
+        _outbox_evento.clear()
+
+
+def estadisticas_outbox():
+    """Tareas pendientes y fallidas en la cola local"""
+    try:
+        db = _db_outbox()
+        pendientes = db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        fallidos = db.execute("SELECT COUNT(*) FROM outbox_fallidos").fetchone()[0]
+        return {"pendientes": pendientes, "fallidos": fallidos}
+    except sqlite3.Error as e:
+        return {"error": str(e)}
+
+
+# ============================================
+# LEADS Y FACTURACIÓN LOCALES (registro si DATOS_DURABLES_DIR es persistente; Sheets es una réplica vía outbox)
+# ============================================
+
+_ESQUEMA_LEADS = """
+CREATE TABLE IF NOT EXISTS leads (
+    id TEXT PRIMARY KEY,
+    fecha TEXT NOT NULL,
+    telefono TEXT NOT NULL,
+    email TEXT NOT NULL,
+    datos TEXT NOT NULL,
+    creado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_leads_telefono ON leads(telefono, creado);
+CREATE INDEX IF NOT EXISTS idx_leads_email ON leads(email, creado);
+CREATE INDEX IF NOT EXISTS idx_leads_fecha ON leads(fecha);
+CREATE TABLE IF NOT EXISTS facturacion (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lead_id TEXT,
+    fecha TEXT NOT NULL,
+    telefono TEXT NOT NULL,
+    email TEXT NOT NULL,
+    datos TEXT NOT NULL,
+    creado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_facturacion_lead ON facturacion(lead_id);
+CREATE INDEX IF NOT EXISTS idx_facturacion_telefono ON facturacion(telefono, creado);
+CREATE INDEX IF NOT EXISTS idx_facturacion_email ON facturacion(email, creado);
+CREATE INDEX IF NOT EXISTS idx_facturacion_fecha ON facturacion(fecha);
+"""
+
+
+if not DATOS_DURABLES_DIR:
+    log_app.warning(f"⚠ DATOS_DURABLES_DIR no configurado: leads.db y outbox.db viven en {DATA_DIR} y se pierden al reiniciar")
+
+
+def _db_leads():
+    return obtener_conexion_db("leads.db", _ESQUEMA_LEADS, DATOS_DURABLES_DIR)
+
+
+def guardar_lead(datos_lead):
+    """Registra el lead y devuelve su id (None si la base local falló)"""
+    lead_id = uuid.uuid4().hex
+    try:
+        _db_leads().execute(
+            "INSERT INTO leads (id, fecha, telefono, email, datos, creado) VALUES (?, ?, ?, ?, ?, ?)",
+            (lead_id, datos_lead['fecha'], datos_lead['telefono'], datos_lead['email'],
+             json.dumps(datos_lead, ensure_ascii=False), time.time()),
+        )
+    except sqlite3.Error as e:
+        log_app.error(f"✗ No se pudo guardar el lead localmente: {e}")
+        return None
+    return lead_id
+
+
+def guardar_facturacion_local(lead_id, datos_fact):
+    """Registra los datos de facturación y devuelve su id (None si la base local falló)"""
+    try:
+        cursor = _db_leads().execute(
+            "INSERT INTO facturacion (lead_id, fecha, telefono, email, datos, creado) VALUES (?, ?, ?, ?, ?, ?)",
+            (lead_id, datos_fact['fecha'], datos_fact['telefono'], datos_fact['email'],
+             json.dumps(datos_fact, ensure_ascii=False), time.time()),
+        )
+    except sqlite3.Error as e:
+        log_app.error(f"✗ No se pudo guardar la facturación localmente: {e}")
+        return None
+    return cursor.lastrowid
+
+
+def _leer_datos(consulta, parametros):
+    try:
+        fila = _db_leads().execute(consulta, parametros).fetchone()
+    except sqlite3.Error as e:
+        log_app.error(f"✗ Error leyendo leads locales: {e}")
+        return None
+    return json.loads(fila[0]) if fila else None
+
+
+def obtener_lead(lead_id):
+    return _leer_datos("SELECT datos FROM leads WHERE id = ?", (lead_id,))
+
+
+def obtener_facturacion(facturacion_id):
+    return _leer_datos("SELECT datos FROM facturacion WHERE id = ?", (facturacion_id,))
+
+
+def lead_de_la_sesion():
+    """Datos del lead de este visitante; solo se confía en el id guardado en la cookie firmada"""
+    lead_id = session.get('lead_id')
+    return (obtener_lead(lead_id) if lead_id else None) or {}
+
+
+# ============================================
+# LÍMITE DE TASA POR CLIENTE (compartido entre workers)
+# ============================================
+
+_SLOT_LIMITE = struct.Struct("<Qdd")  # huella de la clave, fichas, último relleno
+
+
+class LimitadorClientes:
+    """Token buckets por (endpoint, IP) y (endpoint, sesión) en un archivo mapeado en memoria.
+
+    Cada clave cae en un slot de tamaño fijo; el slot se protege con un lock de
+    hilo (dentro del worker) y un fcntl.lockf sobre su rango de bytes (entre
+    workers). Si dos claves chocan en el mismo slot, la nueva lo reinicia.
+    """
+
+    def __init__(self, ruta, slots):
+        self.ruta = ruta
+        self.slots = slots
+        self._mapa = None
+        self._archivo = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(64)]
+
+    def _abrir(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+                archivo = open(self.ruta, "a+b")
+                tamano = self.slots * _SLOT_LIMITE.size
+                if os.fstat(archivo.fileno()).st_size < tamano:
+                    archivo.truncate(tamano)
+                self._mapa = mmap.mmap(archivo.fileno(), tamano)
+                self._archivo = archivo
+                self._pid = os.getpid()
+        return self._mapa
+
+    def consumir(self, clave, rafaga, por_minuto):
+        """Toma una ficha; devuelve 0 si se permitió o los segundos a esperar"""
+        mapa = self._mapa if self._pid == os.getpid() else self._abrir()
+        valor = int.from_bytes(hashlib.blake2b(clave.encode(), digest_size=8).digest(), "little")
+        indice = valor % self.slots
+        huella = valor | 1
+        desplazamiento = indice * _SLOT_LIMITE.size
+        tasa = por_minuto / 60.0
+        with self._locks[indice % len(self._locks)]:
+            fcntl.lockf(self._archivo, fcntl.LOCK_EX, _SLOT_LIMITE.size, desplazamiento)
+            try:
+                huella_slot, fichas, ultimo = _SLOT_LIMITE.unpack_from(mapa, desplazamiento)
+                ahora = time.time()
+                if huella_slot != huella:
+                    fichas, ultimo = float(rafaga), ahora
+                fichas = min(float(rafaga), fichas + (ahora - ultimo) * tasa)
+                espera = 0.0
+                if fichas >= 1:
+                    fichas -= 1
+                else:
+                    espera = (1 - fichas) / tasa
+                _SLOT_LIMITE.pack_into(mapa, desplazamiento, huella, fichas, ahora)
+            finally:
+                fcntl.lockf(self._archivo, fcntl.LOCK_UN, _SLOT_LIMITE.size, desplazamiento)
+        return espera
+
+
+limitador_clientes = LimitadorClientes(os.path.join(DATA_DIR, "limites.bin"), LIMITE_SLOTS)
+
+# endpoint -> peticiones por minuto (y ráfaga) por sesión; por IP se permite LIMITE_FACTOR_IP veces más (NAT, oficinas)
+_PRESUPUESTOS_TASA = {
+    'analizar': LIMITE_ANALIZAR_MINUTO,
+    'analizar_lote': LIMITE_LOTE_MINUTO,
+    'debug': LIMITE_DEBUG_MINUTO,
+}
+
+
+def ip_cliente():
+    """IP del cliente según el proxy de confianza (como ProxyFix: se cuenta desde la derecha).
+
+    Las entradas a la izquierda las puede escribir el propio cliente, así que no sirven de llave.
+    """
+    if PROXIES_CONFIABLES > 0:
+        saltos = request.headers.get('X-Forwarded-For', '').split(',')
+        if len(saltos) >= PROXIES_CONFIABLES and saltos[-PROXIES_CONFIABLES].strip():
+            return saltos[-PROXIES_CONFIABLES].strip()
+    return request.remote_addr or ''
+
+
+def limitar_tasa(endpoint):
+    """Decorador: 429 inmediato si la sesión o la IP agotaron su presupuesto en `endpoint`"""
+    por_minuto = _PRESUPUESTOS_TASA[endpoint]
+
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            if por_minuto > 0:
+                sid = session.get('sid')
+                if sid is None:
+                    sid = session['sid'] = uuid.uuid4().hex
+                espera = limitador_clientes.consumir(f"{endpoint}|s|{sid}", por_minuto, por_minuto)
+                if not espera:
+                    por_minuto_ip = por_minuto * LIMITE_FACTOR_IP
+                    espera = limitador_clientes.consumir(f"{endpoint}|ip|{ip_cliente()}", por_minuto_ip, por_minuto_ip)
+                if espera:
+                    metricas.contar('limite_tasa_rechazos', endpoint=endpoint)
+                    respuesta = jsonify({"error": "Demasiadas solicitudes, intenta de nuevo en un momento"})
+                    respuesta.status_code = 429
+                    respuesta.headers['Retry-After'] = str(math.ceil(espera))
+                    return respuesta
+            return vista(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+# ============================================
+# PÁGINAS PRECOMPRIMIDAS (home y legales)
+# ============================================
+
+class PaginaPrecomprimida:
+    """HTML ya renderizado con sus variantes gzip/br y un ETag fuerte por variante"""
+
+    def __init__(self, html):
+        cuerpo = html.encode('utf-8')
+        self.variantes = {'identity': cuerpo, 'gzip': gzip.compress(cuerpo, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variantes['br'] = brotli.compress(cuerpo, quality=11)
+        self.digest = hashlib.sha256(cuerpo).hexdigest()[:20]
+
+    def _codificacion(self):
+        for codificacion in ('br', 'gzip'):
+            if codificacion in self.variantes and request.accept_encodings.quality(codificacion) > 0:
+                return codificacion
+        return 'identity'
+
+    def respuesta(self):
+        codificacion = self._codificacion()
+        etag = self.digest if codificacion == 'identity' else f"{self.digest}-{codificacion}"
+        cabeceras = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': f"public, max-age={PAGINAS_MAX_AGE}",
+            'Vary': 'Accept-Encoding',
+        }
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=cabeceras)
+        if codificacion != 'identity':
+            cabeceras['Content-Encoding'] = codificacion
+        return Response(self.variantes[codificacion], mimetype='text/html', headers=cabeceras)
+
+
+_paginas = {}
+_paginas_lock = threading.Lock()
+
+
+def pagina_estatica(template):
+    """Responde una plantilla sin variables; se renderiza y comprime una sola vez por proceso"""
+    pagina = _paginas.get(template)
+    if pagina is None:
+        with _paginas_lock:
+            pagina = _paginas.get(template)
+            if pagina is None:
+                pagina = _paginas[template] = PaginaPrecomprimida(render_template(template))
+    return pagina.respuesta()
+
+
+# ============================================
+# ARRANQUE EN FRÍO (precarga en el master de gunicorn y calentamiento por worker)
+# ============================================
+
+_PLANTILLAS_ESTATICAS = (
+    'index.html', 'aviso-legal.html', 'terminos-y-condiciones.html',
+    'politica-de-privacidad.html', 'aviso-de-cookies.html',
+)
+
+
+def _medir_arranque(nombre, funcion):
+    inicio = time.time()
+    try:
+        funcion()
+    except Exception as e:
+        log_app.warning(f"⚠ Arranque: {nombre} falló: {e}")
+    TIEMPOS_ARRANQUE[f"{nombre}_ms"] = round((time.time() - inicio) * 1000, 1)
+
+
+def precargar():
+    """En el master (preload_app): lo pesado e inmutable queda en memoria compartida copy-on-write con los workers"""
+    inicio = time.time()
+    for modulo in (genai, np, bs4):
+        _medir_arranque(f"import_{modulo._nombre}", modulo.cargar)
+    _medir_arranque('corpus_similitud', lambda: cargar_motor_similitud(nativo=False))
+    # Sin esto el GC de cada worker toca los objetos heredados y las páginas se copian de todos modos
+    gc.collect()
+    gc.freeze()
+    TIEMPOS_ARRANQUE['precarga_ms'] = round((time.time() - inicio) * 1000, 1)
+    log_app.info("✓ App precargada en el master", extra=TIEMPOS_ARRANQUE)
+    vaciar_logs()
+
+
+def _calentar_sesion_impi():
+    if circuito_impi.abierto():
+        return
+    sesion = pool_impi.tomar()
+    if sesion.vigente() or sesion.renovar():
+        pool_impi.devolver(sesion)
+    else:
+        pool_impi.descartar(sesion)
+
+
+def _calentar_bases():
+    for conexion in (_db_cache_impi, _db_cache_clases, _db_marcas, _db_outbox, _db_leads):
+        conexion()
+    _asegurar_recarga_similitud()
+
+
+def _calentar_paginas():
+    with app.test_request_context('/'):
+        for template in _PLANTILLAS_ESTATICAS:
+            pagina_estatica(template)
+
+
+def calentar_worker():
+    """Después del fork: modelo Gemini, sesión IMPI, bases locales y páginas antes de la primera visita"""
+    inicio = time.time()
+    if API_KEY_GEMINI:
+        _medir_arranque('calentar_gemini', modelo_gemini)
+    _medir_arranque('calentar_impi', _calentar_sesion_impi)
+    _medir_arranque('calentar_bases', _calentar_bases)
+    _medir_arranque('calentar_paginas', _calentar_paginas)
+    TIEMPOS_ARRANQUE['calentamiento_ms'] = round((time.time() - inicio) * 1000, 1)
+    log_app.info("✓ Worker calentado", extra=TIEMPOS_ARRANQUE)
+
+
+def iniciar_calentamiento():
+    """Hook post_worker_init de gunicorn: calienta en segundo plano para no retrasar el primer accept()"""
+    # Lo que quedó en el outbox antes de un reinicio se entrega sin esperar a un lead nuevo
+    _asegurar_despachador_outbox()
+    if ARRANQUE_CALENTAR:
+        threading.Thread(target=calentar_worker, name="calentamiento", daemon=True).start()
+
+
 # ============================================
 # RUTAS FLASK
 # ============================================
 
+@app.before_request
+def asignar_request_id():
+    _request_id.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16])
+
+
+@app.before_request
+def asegurar_despachador():
+    # Fuera de gunicorn (flask run) no hay hook post_worker_init: el outbox arranca con la primera petición
+    _asegurar_despachador_outbox()
+
+
+@app.after_request
+def exponer_request_id(response):
+    response.headers['X-Request-ID'] = _request_id.get() or ''
+    return response
+
+
+@app.after_request
+def registrar_primera_respuesta(response):
+    # El master nunca atiende, así que cada worker hereda el diccionario sin esta entrada
+    if 'primera_respuesta_ms' not in TIEMPOS_ARRANQUE:
+        TIEMPOS_ARRANQUE['primera_respuesta_ms'] = round((time.time() - ARRANQUE_EPOCH) * 1000, 1)
+        log_app.info("Primera respuesta del worker", extra={"ruta": request.path, **TIEMPOS_ARRANQUE})
+    return response
+
+
+@app.teardown_request
+def limpiar_request_id(error=None):
+    _request_id.set(None)
+
+
 @app.route('/')
 def home():
-    return render_template('index.html')
+    return pagina_estatica('index.html')
 
 
 @app.route('/analizar', methods=['POST'])
+@limitar_tasa('analizar')
 def analizar():
-    """Análisis de marca"""
+    """Análisis de marca; con Accept: text/event-stream envía cada etapa como evento SSE"""
     data = request.json
     marca = data.get('marca', '').strip()
     descripcion = data.get('descripcion', '').strip()
@@ -556,10 +3614,93 @@ def analizar():
     if not marca or not descripcion:
         return jsonify({"error": "Marca y descripción son obligatorias"}), 400
     
-    print(f"\n{'='*70}\nANÁLISIS: {marca}\n{'='*70}")
+    if request.accept_mimetypes.best == 'text/event-stream':
+        eventos = _eventos_sse(etapas_analisis(marca, descripcion, tipo_negocio))
+        return Response(
+            stream_with_context(eventos),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+    
+    return jsonify(analizar_marca(marca, descripcion, tipo_negocio))
+
+
+def _eventos_sse(etapas):
+    """Serializa (evento, datos) como Server-Sent Events"""
+    try:
+        for evento, datos in etapas:
+            yield f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        log_analisis.error(f"✗ Error en el análisis: {e}")
+        yield f"event: error\ndata: {json.dumps({'error': 'Error interno al analizar'})}\n\n"
+
+
+def analizar_marca(marca, descripcion, tipo_negocio):
+    """Clasificación + búsqueda IMPI de una marca; devuelve el resultado para el front"""
+    for evento, datos in etapas_analisis(marca, descripcion, tipo_negocio):
+        if evento == 'resultado':
+            return datos
+
+
+def etapas_analisis(marca, descripcion, tipo_negocio):
+    """Genera (evento, datos) conforme avanza el análisis: clase, impi (progreso) y resultado"""
+    log_analisis.info("Análisis", extra={"marca": marca, "tipo": tipo_negocio})
+    inicio = time.perf_counter()
+    
+    # Una coincidencia exacta en el espejo local evita consultar al IMPI
+    coincidencia_local = coincidencia_exacta_local(marca)
+    
+    # Gemini, IMPI y marcas parecidas en paralelo con un deadline común; lo que no termine usa respaldo
+    limite = time.monotonic() + ANALISIS_DEADLINE
+    executor = obtener_executor()
+    ficha = limite_analisis.set(limite)
+    try:
+        futuro_clase = executor.submit(clasificar_con_gemini, descripcion, tipo_negocio)
+        pendientes = {futuro_clase}
+        if not coincidencia_local:
+            futuro_impi = executor.submit(buscar_impi_cacheado, marca)
+            pendientes.add(futuro_impi)
+        futuro_similares = executor.submit(marcas_similares, marca)
+        pendientes.add(futuro_similares)
+    finally:
+        limite_analisis.reset(ficha)
+    if coincidencia_local:
+        log_espejo.info(f"✓ Coincidencia exacta local para '{marca}'")
+        yield 'impi', {"etapa": "espejo_local"}
+    else:
+        yield 'impi', {"etapa": "consultando"}
+    
+    def evento_clase(clasificacion):
+        return 'clase', {
+            "clase_sugerida": f"Clase {clasificacion['clase_principal']}: {clasificacion['clase_nombre']}",
+            "clase_principal": clasificacion['clase_principal'],
+            "nota_tecnica": clasificacion.get('nota', ''),
+            "mostrar_formulario": True,
+        }
     
-    clasificacion = clasificar_con_gemini(descripcion, tipo_negocio)
-    status_impi = buscar_impi_simple(marca)
+    clasificacion = None
+    while pendientes:
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            break
+        terminados, pendientes = wait(pendientes, timeout=restante, return_when=FIRST_COMPLETED)
+        if futuro_clase in terminados:
+            clasificacion = _resultado_o_respaldo(
+                futuro_clase, lambda: clasificar_por_palabras_clave(descripcion, tipo_negocio), "GEMINI"
+            )
+            yield evento_clase(clasificacion)
+    
+    if clasificacion is None:
+        clasificacion = _resultado_o_respaldo(
+            futuro_clase, lambda: clasificar_por_palabras_clave(descripcion, tipo_negocio), "GEMINI"
+        )
+        yield evento_clase(clasificacion)
+    if coincidencia_local:
+        status_impi = "REQUIERE_ANALISIS"
+    else:
+        status_impi = _resultado_o_respaldo(futuro_impi, lambda: "ERROR_CONEXION", "IMPI")
+        yield 'impi', {"etapa": "terminado", "status_impi": status_impi}
+    similares = _resultado_o_respaldo(futuro_similares, list, "SIMILITUD")
     
     clase_sugerida = f"Clase {clasificacion['clase_principal']}: {clasificacion['clase_nombre']}"
     
@@ -576,7 +3717,9 @@ def analizar():
         icono, color = "🔄", "info"
         cta = "Déjanos tus datos para búsqueda manual."
     
-    return jsonify({
+    metricas.observar('analisis', time.perf_counter() - inicio)
+    metricas.contar('status_impi', status=status_impi)
+    yield 'resultado', {
         "mensaje": mensaje,
         "icono": icono,
         "color": color,
@@ -585,9 +3728,97 @@ def analizar():
         "mostrar_formulario": True,
         "cta": cta,
         "status_impi": status_impi,
+        "marcas_similares": similares[:5],
         "tipo_negocio": tipo_negocio,
         "precio_reporte": PRECIO_REPORTE,
-    })
+    }
+
+
+@app.route('/analizar/lote', methods=['POST'])
+@limitar_tasa('analizar_lote')
+def analizar_lote():
+    """Análisis de una lista de marcas (JSON o CSV); resultados en NDJSON conforme terminan"""
+    filas = _leer_filas_lote()
+    if filas is None:
+        return jsonify({"error": "Envía una lista JSON de marcas, {\"marcas\": [...]} o un CSV"}), 400
+    items = _items_lote(filas)
+    return Response(stream_with_context(_generar_resultados_lote(items)), mimetype='application/x-ndjson')
+
+
+def _leer_filas_lote():
+    """Filas del cuerpo (lista JSON, {'marcas': [...]} o CSV); None si el cuerpo no es válido"""
+    tipo_contenido = request.mimetype or ''
+    if 'archivo' in request.files or tipo_contenido in ('text/csv', 'application/csv'):
+        if 'archivo' in request.files:
+            flujo = io.TextIOWrapper(request.files['archivo'].stream, encoding='utf-8-sig')
+        else:
+            flujo = io.TextIOWrapper(request.stream, encoding='utf-8-sig')
+        return csv.DictReader(flujo)
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('marcas')
+    return data if isinstance(data, list) else None
+
+
+def _items_lote(filas):
+    """Itera (marca, descripcion, tipo) de cada fila; None para las que no son un objeto"""
+    for fila in filas:
+        if not isinstance(fila, dict):
+            yield None
+            continue
+        fila = {(k or '').strip().lower(): v for k, v in fila.items()}
+        yield (
+            str(fila.get('marca') or '').strip(),
+            str(fila.get('descripcion') or '').strip(),
+            str(fila.get('tipo') or 'servicio').strip().lower(),
+        )
+
+
+def _analizar_item_lote(indice, item):
+    if item is None:
+        return {"indice": indice, "error": "Formato de elemento inválido"}
+    marca, descripcion, tipo_negocio = item
+    if not marca or not descripcion:
+        return {"indice": indice, "marca": marca, "error": "Marca y descripción son obligatorias"}
+    # Cada tarea corre en su propia copia del contexto: no hace falta restaurarlo
+    en_lote.set(True)
+    try:
+        return {"indice": indice, "marca": marca, **analizar_marca(marca, descripcion, tipo_negocio)}
+    except Exception as e:
+        log_analisis.error(f"✗ Error en '{marca}': {e}")
+        return {"indice": indice, "marca": marca, "error": "Error interno al analizar"}
+
+
+def _generar_resultados_lote(items):
+    """Analiza con concurrencia acotada; emite una línea JSON por marca en orden de término"""
+    total = errores = 0
+    en_vuelo = set()
+    
+    def emitir(terminados):
+        nonlocal errores
+        for futuro in terminados:
+            resultado = futuro.result()
+            errores += 'error' in resultado
+            yield json.dumps(resultado, ensure_ascii=False) + "\n"
+    
+    with EjecutorConContexto(max_workers=LOTE_CONCURRENCIA, thread_name_prefix="lote") as executor:
+        for indice, item in enumerate(items):
+            if indice >= LOTE_MAX_ITEMS:
+                yield json.dumps({"error": f"Máximo {LOTE_MAX_ITEMS} marcas por lote"}, ensure_ascii=False) + "\n"
+                break
+            # No se leen más elementos mientras la ventana de trabajo esté llena
+            if len(en_vuelo) >= LOTE_CONCURRENCIA:
+                terminados, en_vuelo = wait(en_vuelo, return_when=FIRST_COMPLETED)
+                yield from emitir(terminados)
+            en_vuelo.add(executor.submit(_analizar_item_lote, indice, item))
+            total += 1
+        
+        while en_vuelo:
+            terminados, en_vuelo = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            yield from emitir(terminados)
+    
+    log_analisis.info(f"✓ {total} marcas analizadas ({errores} con error)")
+    yield json.dumps({"resumen": {"total": total, "errores": errores}}) + "\n"
 
 
 @app.route('/capturar-lead', methods=['POST'])
@@ -613,15 +3844,19 @@ def capturar_lead():
         if not all([datos_lead['nombre'], datos_lead['email'], datos_lead['telefono']]):
             return jsonify({"success": False, "error": "Todos los campos son obligatorios"}), 400
         
-        print(f"\n[LEAD] {datos_lead['nombre']} - {datos_lead['telefono']}")
-        
-        # Guardar en Sheets
-        sheets_ok = guardar_en_sheets(datos_lead, hoja="leads")
-        print(f"[SHEETS] Resultado: {sheets_ok}")
+        lead_id = guardar_lead(datos_lead)
+        if lead_id:
+            session['lead_id'] = lead_id
+        log_app.info("Lead recibido", extra={"lead_id": lead_id, "nombre": datos_lead['nombre'], "telefono": datos_lead['telefono']})
         
-        # Enviar notificación push (invisible para el usuario)
-        push_ok = enviar_notificacion_push(datos_lead)
-        print(f"[PUSH] Resultado: {push_ok}")
+        # Réplica en Sheets, notificación push y email (invisible para el usuario) vía outbox
+        tareas = [
+            ('sheets', {'hoja': 'leads', 'datos': datos_lead}),
+            ('push', datos_lead),
+        ]
+        if GMAIL_USER and GMAIL_PASSWORD:
+            tareas.append(('email', datos_lead))
+        encolar_tareas(tareas)
         
         # Responder éxito (sin WhatsApp visible)
         respuesta = {
@@ -643,20 +3878,18 @@ def capturar_lead():
             },
         }
         
-        print(f"[RESPONSE] Enviando respuesta exitosa")
+        log_app.debug("Enviando respuesta exitosa")
         return jsonify(respuesta)
         
     except Exception as e:
-        print(f"[ERROR] capturar-lead: {e}")
-        import traceback
-        traceback.print_exc()
+        log_app.exception(f"✗ Error en capturar-lead: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 @app.route('/facturacion')
 def facturacion():
     """FORM 2: Facturación post-pago"""
-    lead_data = session.get('lead_data', {})
+    lead_data = lead_de_la_sesion()
     telefono = lead_data.get('telefono', request.args.get('tel', ''))
     return render_template('facturacion.html', telefono=telefono, lead_data=lead_data)
 
@@ -682,11 +3915,17 @@ def guardar_facturacion():
     if not datos_fact['telefono'] or not datos_fact['email']:
         return jsonify({"error": "Teléfono y email obligatorios"}), 400
     
-    guardar_en_sheets(datos_fact, hoja="facturacion")
-    session['facturacion_data'] = datos_fact
+    facturacion_id = guardar_facturacion_local(session.get('lead_id'), datos_fact)
+    if facturacion_id:
+        session['facturacion_id'] = facturacion_id
+    else:
+        session['facturacion_data'] = datos_fact
     
-    # Enviar notificación push de NUEVO CLIENTE (pago completado)
-    enviar_notificacion_push_pago(datos_fact)
+    # Réplica en Sheets y notificación push de NUEVO CLIENTE (pago completado) vía outbox
+    encolar_tareas([
+        ('sheets', {'hoja': 'facturacion', 'datos': datos_fact}),
+        ('push_pago', datos_fact),
+    ])
     
     return jsonify({"success": True, "redirect": "/confirmacion"})
 
@@ -694,8 +3933,10 @@ def guardar_facturacion():
 @app.route('/confirmacion')
 def confirmacion():
     """Página final con calendario y WhatsApp"""
-    lead_data = session.get('lead_data', {})
+    lead_data = lead_de_la_sesion()
     fact_data = session.get('facturacion_data', {})
+    if 'facturacion_id' in session:
+        fact_data = obtener_facturacion(session['facturacion_id']) or fact_data
     telefono = fact_data.get('telefono', lead_data.get('telefono', ''))
     email_cliente = fact_data.get('email', lead_data.get('email', ''))
     nombre_cliente = lead_data.get('nombre', '')
@@ -718,40 +3959,69 @@ def health():
         "status": "ok",
         "version": "funnel-2.1",
         "precio": PRECIO_REPORTE,
+        "outbox": estadisticas_outbox(),
+        "sheets_lotes": escritor_sheets.estadisticas(),
+        "cache_niza": estadisticas_cache_clases(),
+        "impi": {**circuito_impi.estadisticas(), "concurrencia": concurrencia_impi.estadisticas()},
+        "leads": {"persistentes": bool(DATOS_DURABLES_DIR)},
+        "arranque": {"pid": os.getpid(), **TIEMPOS_ARRANQUE},
     })
 
 
+@app.route('/metrics')
+def metrics():
+    """Métricas de todos los workers en formato Prometheus"""
+    metricas.volcar()
+    histogramas, contadores = metricas.agregadas()
+    
+    # Lo que ya vive en SQLite es global: se lee directo en vez de sumarlo por worker
+    cache_niza = estadisticas_cache_clases()
+    medidores = []
+    outbox = estadisticas_outbox()
+    for estado in ('pendientes', 'fallidos'):
+        if estado in outbox:
+            medidores.append(('outbox_tareas', (('estado', estado),), outbox[estado]))
+    if 'entradas' in cache_niza:
+        medidores.append(('cache_niza_entradas', (), cache_niza['entradas']))
+    
+    return Response(
+        exposicion_prometheus(histogramas, contadores, medidores),
+        mimetype='text/plain; version=0.0.4',
+    )
+
+
 # ============================================
 # PÁGINAS LEGALES
 # ============================================
 
 @app.route('/aviso-legal')
 def aviso_legal():
-    return render_template('aviso-legal.html')
+    return pagina_estatica('aviso-legal.html')
 
 @app.route('/terminos-y-condiciones')
 def terminos_condiciones():
-    return render_template('terminos-y-condiciones.html')
+    return pagina_estatica('terminos-y-condiciones.html')
 
 @app.route('/politica-de-privacidad')
 def politica_privacidad():
-    return render_template('politica-de-privacidad.html')
+    return pagina_estatica('politica-de-privacidad.html')
 
 @app.route('/aviso-de-cookies')
 def aviso_cookies():
-    return render_template('aviso-de-cookies.html')
+    return pagina_estatica('aviso-de-cookies.html')
 
 
 @app.route('/debug/test/<marca>')
+@limitar_tasa('debug')
 def debug_test(marca):
     return jsonify({"marca": marca, "resultado": buscar_impi_simple(marca)})
 
 
+TIEMPOS_ARRANQUE['importacion_ms'] = round((time.time() - _INICIO_IMPORTACION) * 1000, 1)
+log_app.info("✓ App importada", extra=TIEMPOS_ARRANQUE)
+
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))
-    print(f"\n{'='*70}")
-    print(f"🌐 CONSULTOR DE MARCAS - FUNNEL v2.1")
-    print(f"URL: {APP_BASE_URL}")
-    print(f"Precio: ${PRECIO_REPORTE} MXN")
-    print(f"{'='*70}\n")
+    log_app.info("🌐 CONSULTOR DE MARCAS - FUNNEL v2.1", extra={"url": APP_BASE_URL, "precio": PRECIO_REPORTE})
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,40 @@
+"""Benchmark del parser de respuestas IMPI sobre los fixtures de benchmarks/fixtures.
+
+Uso: python benchmarks/bench_parser_impi.py [repeticiones]
+"""
+import glob
+import os
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from app import parsear_respuesta_impi, status_desde_respuesta_impi  # noqa: E402
+
+
+def medir(funcion, texto, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion(texto)
+    return (time.perf_counter() - inicio) / repeticiones
+
+
+def main():
+    repeticiones = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    fixtures = sorted(glob.glob(os.path.join(RAIZ, 'benchmarks', 'fixtures', 'impi_*.xml')))
+
+    print(f"{'fixture':<28}{'bytes':>8}{'registros':>11}{'status':>26}{'µs/página':>12}")
+    for ruta in fixtures:
+        with open(ruta, encoding='utf-8') as f:
+            texto = f.read()
+        resultado = parsear_respuesta_impi(texto)
+        t_parser = medir(parsear_respuesta_impi, texto, repeticiones)
+        print(
+            f"{os.path.basename(ruta):<28}{len(texto):>8}{len(resultado['registros']):>11}"
+            f"{status_desde_respuesta_impi(resultado):>26}{t_parser * 1e6:>12.1f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Benchmark del motor de similitud sobre un corpus sintético.
+
+Uso: python benchmarks/bench_similitud.py [tamaño_corpus] [repeticiones]
+"""
+import os
+import random
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from app import MotorSimilitud, clave_fonetica, normalizar_denominacion  # noqa: E402
+
+SILABAS = [
+    'ca', 'sa', 'za', 'va', 'ba', 'lla', 'ya', 'che', 'que', 'gue', 'ge', 'je', 'ha', 'ma', 'no',
+    'ri', 'to', 'lu', 'mi', 'xo', 'ñe', 'pe', 'di', 'fo', 'ro', 'el', 'an', 'or', 'es', 'in',
+]
+
+
+def corpus_sintetico(tamano, semilla=42):
+    azar = random.Random(semilla)
+    filas = []
+    for i in range(tamano):
+        palabras = [
+            ''.join(azar.choice(SILABAS) for _ in range(azar.randint(1, 4)))
+            for _ in range(azar.randint(1, 3))
+        ]
+        denominacion = ' '.join(palabras).upper()
+        norm = normalizar_denominacion(denominacion)
+        filas.append((denominacion, norm, clave_fonetica(norm), azar.randint(1, 45), 'REGISTRO DE MARCA', str(i)))
+    return filas
+
+
+def main():
+    tamano = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    inicio = time.perf_counter()
+    filas = corpus_sintetico(tamano)
+    motor = MotorSimilitud()
+    motor.cargar(filas)
+    print(f"Corpus: {tamano} marcas, preparado en {time.perf_counter() - inicio:.2f}s")
+
+    for marca in ['Casa Bella', 'Vaca Yena', 'Chequemate', 'Gelato Rico']:
+        motor.top_k(marca)
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            resultado = motor.top_k(marca, k=5)
+        ms = (time.perf_counter() - inicio) / repeticiones * 1000
+        mejores = ', '.join(f"{r['denominacion']} ({r['similitud']})" for r in resultado[:3])
+        print(f"{marca:<14}{ms:>8.1f} ms   {mejores}")
+
+
+if __name__ == '__main__':
+    main()
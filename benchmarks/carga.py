@@ -0,0 +1,249 @@
+"""Prueba de carga de /analizar, /capturar-lead y /guardar-facturacion contra servicios falsos.
+
+Levanta benchmarks/servicios_falsos.py, arranca la app con gunicorn.conf.py apuntando a ellos
+(o usa --url para una app ya corriendo) y genera carga de lazo abierto a la tasa pedida.
+La latencia se mide desde el instante programado de cada petición, así que una app
+saturada no esconde su cola atrás del generador.
+
+Uso:
+    python benchmarks/carga.py --rps 20 --duracion 30
+    python benchmarks/carga.py --rps 50 --mezcla analizar=8,capturar-lead=1,guardar-facturacion=1 \\
+        --impi-latencia 2 --impi-error 0.1
+    WEB_WORKER_CLASS=gthread python benchmarks/carga.py --rps 20   # comparar modos de gunicorn
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, 'benchmarks'))
+
+from servicios_falsos import Perfil, ServiciosFalsos  # noqa: E402
+
+DESCRIPCIONES = [
+    ('restaurante de tacos y antojitos', 'servicio'),
+    ('ropa deportiva para mujer', 'producto'),
+    ('aplicación móvil para agendar citas', 'producto'),
+    ('despacho contable y asesoría fiscal', 'servicio'),
+    ('cerveza artesanal', 'producto'),
+    ('clínica dental', 'servicio'),
+    ('cafetería con pan dulce', 'servicio'),
+    ('agencia de marketing digital', 'servicio'),
+]
+
+# nota_tecnica de los respaldos de clasificación (Gemini falló o no llegó antes del deadline)
+NOTAS_RESPALDO = {'Clasificación automática', 'Clasificación por defecto', 'IA no disponible'}
+
+# Estado de cada petición: ok, respaldo (200 pero con el resultado degradado) o error
+OK, RESPALDO, ERROR = 'ok', 'respaldo', 'error'
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano sobre una lista ordenada"""
+    if not valores:
+        return 0.0
+    indice = max(0, min(len(valores) - 1, int(round(p / 100 * len(valores) + 0.5)) - 1))
+    return valores[indice]
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Cliente:
+    """Genera las peticiones de cada endpoint; una sesión HTTP por hilo"""
+
+    def __init__(self, url, marcas_distintas):
+        self.url = url.rstrip('/')
+        self.marcas_distintas = marcas_distintas
+        self._local = threading.local()
+
+    def _http(self):
+        if not hasattr(self._local, 'sesion'):
+            self._local.sesion = requests.Session()
+        return self._local.sesion
+
+    def _marca(self):
+        return f"Bench {random.randrange(self.marcas_distintas)}"
+
+    def analizar(self):
+        descripcion, tipo = random.choice(DESCRIPCIONES)
+        r = self._http().post(f"{self.url}/analizar", json={
+            'marca': self._marca(), 'descripcion': descripcion, 'tipo': tipo,
+        }, timeout=60)
+        if r.status_code != 200:
+            return ERROR
+        data = r.json()
+        if 'status_impi' not in data:
+            return ERROR
+        if data['status_impi'] == 'ERROR_CONEXION' or data.get('nota_tecnica') in NOTAS_RESPALDO:
+            return RESPALDO
+        return OK
+
+    def capturar_lead(self):
+        descripcion, tipo = random.choice(DESCRIPCIONES)
+        n = random.randrange(10**6)
+        r = self._http().post(f"{self.url}/capturar-lead", json={
+            'nombre': f"Cliente {n}", 'email': f"cliente{n}@example.com", 'telefono': f"33{n:08d}",
+            'marca': self._marca(), 'descripcion': descripcion, 'tipo_negocio': tipo,
+            'clase_sugerida': 'Clase 35: Publicidad', 'resultado': 'bench', 'status_impi': 'POSIBLEMENTE_DISPONIBLE',
+        }, timeout=60)
+        return OK if r.status_code == 200 and r.json().get('success') else ERROR
+
+    def guardar_facturacion(self):
+        n = random.randrange(10**6)
+        r = self._http().post(f"{self.url}/guardar-facturacion", json={
+            'telefono': f"33{n:08d}", 'email': f"cliente{n}@example.com", 'requiere_factura': 'Sí',
+            'rfc': 'XAXX010101000', 'razon_social': f"Cliente {n} SA de CV", 'regimen_fiscal': '601',
+            'uso_cfdi': 'G03', 'codigo_postal': '44100',
+        }, timeout=60)
+        return OK if r.status_code == 200 and r.json().get('success') else ERROR
+
+
+def leer_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(','):
+        nombre, _, peso = parte.partition('=')
+        mezcla[nombre.strip()] = float(peso or 1)
+    return mezcla
+
+
+def generar_carga(cliente, mezcla, rps, duracion, max_en_vuelo):
+    """Carga de lazo abierto; devuelve {endpoint: [(latencia, estado), ...]} y la duración real"""
+    endpoints = list(mezcla)
+    pesos = [mezcla[e] for e in endpoints]
+    funciones = {e: getattr(cliente, e.replace('-', '_')) for e in endpoints}
+    resultados = {e: [] for e in endpoints}
+    lock = threading.Lock()
+
+    def ejecutar(endpoint, programado):
+        try:
+            estado = funciones[endpoint]()
+        except Exception:
+            estado = ERROR
+        latencia = time.perf_counter() - programado
+        with lock:
+            resultados[endpoint].append((latencia, estado))
+
+    total = int(rps * duracion)
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_en_vuelo) as executor:
+        for i in range(total):
+            programado = inicio + i / rps
+            espera = programado - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            executor.submit(ejecutar, random.choices(endpoints, pesos)[0], programado)
+    return resultados, time.perf_counter() - inicio
+
+
+def reporte(resultados, duracion):
+    """Tabla por endpoint; ok/s solo cuenta respuestas completas (sin error ni respaldo)"""
+    print(f"\n{'endpoint':<22}{'n':>7}{'error %':>9}{'respaldo %':>12}{'ok/s':>8}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for endpoint, muestras in resultados.items():
+        if not muestras:
+            continue
+        latencias = sorted(l * 1000 for l, _ in muestras)
+        errores = sum(1 for _, estado in muestras if estado == ERROR)
+        respaldos = sum(1 for _, estado in muestras if estado == RESPALDO)
+        completas = len(muestras) - errores - respaldos
+        print(
+            f"{endpoint:<22}{len(muestras):>7}{100 * errores / len(muestras):>9.1f}"
+            f"{100 * respaldos / len(muestras):>12.1f}"
+            f"{completas / duracion:>8.1f}{percentil(latencias, 50):>10.1f}"
+            f"{percentil(latencias, 95):>10.1f}{percentil(latencias, 99):>10.1f}{latencias[-1]:>10.1f}"
+        )
+
+
+def arrancar_app(entorno_servicios, directorio):
+    puerto = puerto_libre()
+    entorno = {**os.environ, **entorno_servicios, 'DATA_DIR': os.path.join(directorio, 'datos')}
+    # el generador usa pocas sesiones desde 127.0.0.1: sin límite por cliente salvo que se pida
+    for variable in ('LIMITE_ANALIZAR_MINUTO', 'LIMITE_LOTE_MINUTO'):
+        entorno.setdefault(variable, '0')
+    log = open(os.path.join(directorio, 'app.log'), 'w')
+    proceso = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '-c', 'gunicorn.conf.py', '--bind', f"127.0.0.1:{puerto}"],
+        cwd=RAIZ, env=entorno, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{puerto}"
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError(f"La app terminó al arrancar; ver {log.name}")
+        try:
+            if requests.get(f"{url}/health", timeout=2).status_code == 200:
+                return proceso, url
+        except requests.RequestException:
+            time.sleep(0.3)
+    proceso.terminate()
+    raise RuntimeError(f"La app no respondió /health; ver {log.name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='app ya corriendo (no se arrancan app ni servicios falsos)')
+    parser.add_argument('--rps', type=float, default=10)
+    parser.add_argument('--duracion', type=float, default=20, help='segundos de carga')
+    parser.add_argument('--mezcla', default='analizar=6,capturar-lead=3,guardar-facturacion=1')
+    parser.add_argument('--marcas-distintas', type=int, default=1000, help='menos marcas = más aciertos de caché')
+    parser.add_argument('--max-en-vuelo', type=int, default=512)
+    parser.add_argument('--drenar', type=float, default=5, help='segundos para que el outbox termine antes del reporte')
+    for servicio, latencia in (('impi', 0.5), ('gemini', 0.4), ('sheets', 0.8), ('ntfy', 0.1), ('smtp', 0.05)):
+        parser.add_argument(f'--{servicio}-latencia', type=float, default=latencia)
+        parser.add_argument(f'--{servicio}-error', type=float, default=0.0)
+    args = parser.parse_args()
+
+    servicios = proceso = None
+    directorio = tempfile.mkdtemp(prefix='bench-marcasegura-')
+    url = args.url
+    try:
+        if not url:
+            servicios = ServiciosFalsos({
+                'marcanet': Perfil(args.impi_latencia, tasa_error=args.impi_error),
+                'gemini': Perfil(args.gemini_latencia, tasa_error=args.gemini_error),
+                'sheets': Perfil(args.sheets_latencia, tasa_error=args.sheets_error),
+                'ntfy': Perfil(args.ntfy_latencia, tasa_error=args.ntfy_error),
+                'smtp': Perfil(args.smtp_latencia, tasa_error=args.smtp_error),
+            }).iniciar()
+            proceso, url = arrancar_app(servicios.entorno(), directorio)
+            print(f"App en {url} (log: {os.path.join(directorio, 'app.log')})")
+
+        mezcla = leer_mezcla(args.mezcla)
+        print(f"Carga: {args.rps} rps durante {args.duracion}s, mezcla {mezcla}")
+        resultados, duracion = generar_carga(
+            Cliente(url, args.marcas_distintas), mezcla, args.rps, args.duracion, args.max_en_vuelo
+        )
+        reporte(resultados, duracion)
+
+        if servicios:
+            time.sleep(args.drenar)
+            print("\nLlamadas recibidas por los servicios falsos:")
+            print(json.dumps(servicios.estadisticas(), indent=2))
+            try:
+                print(json.dumps(requests.get(f"{url}/health", timeout=5).json(), indent=2, ensure_ascii=False))
+            except requests.RequestException:
+                pass
+    finally:
+        if proceso:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+        if servicios:
+            servicios.detener()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Servidores locales que sustituyen a los servicios externos durante las pruebas de carga.
+
+- marcanet: GET /marcanet/ con ViewState y POST de búsqueda que repite los fixtures grabados
+- gemini: API REST generateContent (responde prompts simples y numerados)
+- sheets: endpoint de Apps Script (filas sueltas y lotes con acuse por fila)
+- ntfy: POST /<canal>
+- smtp: SMTP mínimo con AUTH PLAIN/LOGIN, sin TLS
+
+Cada servicio HTTP tiene latencia (media ± variación) y tasa de errores configurables.
+
+Uso directo: python benchmarks/servicios_falsos.py  (imprime las variables de entorno para la app)
+"""
+import glob
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGINA_MARCANET = """<html><body><form id="frmBsqDen">
+<input type="hidden" name="javax.faces.ViewState" id="javax.faces.ViewState" value="{viewstate}" />
+</form></body></html>"""
+
+
+class Perfil:
+    """Latencia y errores simulados de un servicio"""
+
+    def __init__(self, latencia=0.05, variacion=0.5, tasa_error=0.0):
+        self.latencia = latencia
+        self.variacion = variacion
+        self.tasa_error = tasa_error
+
+    def esperar(self):
+        if self.latencia > 0:
+            time.sleep(max(0.0, random.uniform(1 - self.variacion, 1 + self.variacion) * self.latencia))
+
+    def falla(self):
+        return random.random() < self.tasa_error
+
+
+class ServidorFalso(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, servicio, perfil, puerto=0):
+        super().__init__(('127.0.0.1', puerto), _ManejadorFalso)
+        self.servicio = servicio
+        self.perfil = perfil
+        self.contadores = {'peticiones': 0, 'errores': 0}
+        self._lock = threading.Lock()
+        self.fixtures = []
+        if servicio == 'marcanet':
+            for ruta in sorted(glob.glob(os.path.join(RAIZ, 'benchmarks', 'fixtures', 'impi_*.xml'))):
+                with open(ruta, encoding='utf-8') as f:
+                    self.fixtures.append(f.read().encode('utf-8'))
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def contar(self, clave):
+        with self._lock:
+            self.contadores[clave] += 1
+
+
+class _ManejadorFalso(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, formato, *args):
+        pass
+
+    def _responder(self, codigo, cuerpo, tipo='application/json', cabeceras=None):
+        if isinstance(cuerpo, (dict, list)):
+            cuerpo = json.dumps(cuerpo, ensure_ascii=False)
+        if isinstance(cuerpo, str):
+            cuerpo = cuerpo.encode('utf-8')
+        self.send_response(codigo)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        for nombre, valor in (cabeceras or {}).items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _leer_cuerpo(self):
+        largo = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(largo) if largo else b''
+
+    def _atender(self):
+        servidor = self.server
+        cuerpo = self._leer_cuerpo()
+        servidor.contar('peticiones')
+        servidor.perfil.esperar()
+        if servidor.perfil.falla():
+            servidor.contar('errores')
+            self._responder(503, {'error': 'falla simulada'})
+            return
+        getattr(self, f"_{servidor.servicio}")(cuerpo)
+
+    do_GET = _atender
+    do_POST = _atender
+
+    def _marcanet(self, cuerpo):
+        if self.command == 'GET':
+            viewstate = f"-{random.randint(10**17, 10**18)}:{random.randint(10**17, 10**18)}"
+            self._responder(
+                200, PAGINA_MARCANET.format(viewstate=viewstate), 'text/html; charset=UTF-8',
+                {'Set-Cookie': f"JSESSIONID={random.getrandbits(64):x}; Path=/marcanet"},
+            )
+        else:
+            self._responder(200, random.choice(self.server.fixtures), 'text/xml; charset=UTF-8')
+
+    def _gemini(self, cuerpo):
+        prompt = ''
+        try:
+            for contenido in json.loads(cuerpo).get('contents', []):
+                for parte in contenido.get('parts', []):
+                    prompt += parte.get('text', '')
+        except ValueError:
+            pass
+        n = len(re.findall(r'\(Tipo: ', prompt))
+        if 'Clasifica cada uno' in prompt:
+            texto = '\n'.join(f"{i}) 35|Publicidad y negocios|Respuesta simulada" for i in range(1, n + 1))
+        else:
+            texto = '35|Publicidad y negocios|Respuesta simulada'
+        self._responder(200, {
+            'candidates': [{'content': {'parts': [{'text': texto}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+            'usageMetadata': {'promptTokenCount': len(prompt) // 4, 'candidatesTokenCount': len(texto) // 4},
+        })
+
+    def _sheets(self, cuerpo):
+        try:
+            payload = json.loads(cuerpo)
+        except ValueError:
+            payload = {}
+        if payload.get('lote'):
+            self._responder(200, {'resultados': [{'ok': True} for _ in payload.get('datos', [])]})
+        else:
+            self._responder(200, {'status': 'ok'})
+
+    def _ntfy(self, cuerpo):
+        self._responder(200, {'id': f"{random.getrandbits(48):x}", 'event': 'message', 'topic': self.path.strip('/')})
+
+
+class ServidorSMTPFalso(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, perfil, puerto=0):
+        super().__init__(('127.0.0.1', puerto), _ManejadorSMTP)
+        self.perfil = perfil
+        self.contadores = {'conexiones': 0, 'mensajes': 0, 'errores': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def puerto(self):
+        return self.server_address[1]
+
+    def contar(self, clave):
+        with self._lock:
+            self.contadores[clave] += 1
+
+
+class _ManejadorSMTP(socketserver.StreamRequestHandler):
+
+    def _enviar(self, linea):
+        self.wfile.write((linea + '\r\n').encode('ascii'))
+
+    def handle(self):
+        servidor = self.server
+        servidor.contar('conexiones')
+        self._enviar('220 localhost ESMTP falso')
+        while True:
+            linea = self.rfile.readline()
+            if not linea:
+                return
+            comando = linea.decode('utf-8', 'replace').strip()
+            verbo = comando.split(' ', 1)[0].upper()
+            if verbo in ('EHLO', 'HELO'):
+                self._enviar('250-localhost')
+                self._enviar('250-AUTH PLAIN LOGIN')
+                self._enviar('250 8BITMIME')
+            elif verbo == 'AUTH':
+                if comando.upper().startswith('AUTH LOGIN'):
+                    self._enviar('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self._enviar('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self._enviar('235 2.7.0 Authentication successful')
+            elif verbo == 'DATA':
+                self._enviar('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                servidor.perfil.esperar()
+                if servidor.perfil.falla():
+                    servidor.contar('errores')
+                    self._enviar('451 4.3.0 Falla simulada')
+                else:
+                    servidor.contar('mensajes')
+                    self._enviar('250 2.0.0 OK')
+            elif verbo == 'QUIT':
+                self._enviar('221 2.0.0 Bye')
+                return
+            elif verbo in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self._enviar('250 2.0.0 OK')
+            else:
+                self._enviar('502 5.5.2 Command not recognized')
+
+
+class ServiciosFalsos:
+    """Levanta todos los servicios en puertos libres; `entorno()` da las variables para la app"""
+
+    def __init__(self, perfiles=None):
+        perfiles = perfiles or {}
+        self.http = {
+            servicio: ServidorFalso(servicio, perfiles.get(servicio, Perfil()))
+            for servicio in ('marcanet', 'gemini', 'sheets', 'ntfy')
+        }
+        self.smtp = ServidorSMTPFalso(perfiles.get('smtp', Perfil(latencia=0.02)))
+
+    def iniciar(self):
+        for servidor in [*self.http.values(), self.smtp]:
+            threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        for servidor in [*self.http.values(), self.smtp]:
+            servidor.shutdown()
+            servidor.server_close()
+
+    def entorno(self):
+        return {
+            'IMPI_ORIGEN': self.http['marcanet'].url,
+            'GEMINI_ENDPOINT': self.http['gemini'].url,
+            'API_KEY_GEMINI': 'clave-falsa',
+            'GOOGLE_APPS_SCRIPT_URL': f"{self.http['sheets'].url}/exec",
+            'SHEETS_LOTES': 'true',
+            'NTFY_URL': self.http['ntfy'].url,
+            'SMTP_HOST': '127.0.0.1',
+            'SMTP_PORT': str(self.smtp.puerto),
+            'SMTP_STARTTLS': 'false',
+            'GMAIL_USER': 'bench@localhost',
+            'GMAIL_PASSWORD': 'bench',
+        }
+
+    def estadisticas(self):
+        datos = {servicio: dict(servidor.contadores) for servicio, servidor in self.http.items()}
+        datos['smtp'] = dict(self.smtp.contadores)
+        return datos
+
+
+def main():
+    servicios = ServiciosFalsos().iniciar()
+    for nombre, valor in servicios.entorno().items():
+        print(f"export {nombre}={valor}")
+    print("# Ctrl+C para terminar")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servicios.detener()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Configuración de gunicorn (Procfile: gunicorn app:app -c gunicorn.conf.py)
+
+WEB_WORKER_CLASS=gevent (por defecto): I/O cooperativo; IMPI, Gemini, Apps Script y ntfy
+    se esperan sin ocupar un hilo del sistema, hasta WEB_CONEXIONES peticiones por worker.
+WEB_WORKER_CLASS=gthread: modo clásico de --workers 2 --threads 4.
+WEB_PRECARGA=true (por defecto): la app se importa una vez en el master y los workers nacen
+    con ella (memoria compartida copy-on-write); cada worker se calienta al arrancar
+    (ARRANQUE_CALENTAR). Los tiempos quedan en el log y en /health -> "arranque".
+"""
+import os
+import time
+
+# Referencia para medir el tiempo hasta la primera respuesta de cada worker
+os.environ.setdefault("ARRANQUE_EPOCH", str(time.time()))
+
+worker_class = os.environ.get("WEB_WORKER_CLASS", "gevent")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("WEB_THREADS", 4))
+# Cada conexión en espera es un greenlet (unos KB), no un hilo con su pila
+worker_connections = int(os.environ.get("WEB_CONEXIONES", 500))
+timeout = int(os.environ.get("WEB_TIMEOUT", 120))
+preload_app = os.environ.get("WEB_PRECARGA", "true").lower() == "true"
+
+if preload_app and worker_class == "gevent":
+    # La app se importa antes del fork: se parchea ya, como lo haría el worker, para que
+    # los locks, sockets y MODO_GEVENT de app.py sean los de gevent
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def when_ready(server):
+    # Master listo y workers aún sin crear: importaciones pesadas y corpus antes del fork
+    if preload_app:
+        import app
+        app.precargar()
+
+
+def post_worker_init(worker):
+    import app
+    app.iniciar_calentamiento()